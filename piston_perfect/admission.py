@@ -0,0 +1,55 @@
+"""
+Admission control. See :attr:`.handlers.BaseHandler.max_concurrency`.
+"""
+
+import collections, threading
+
+
+class Limiter(object):
+	"""
+	Bounded semaphore with a bounded first-come, first-served queue. A slot
+	that is released goes to the request that has been waiting longest,
+	rather than to whichever thread happens to grab it first.
+	"""
+
+	def __init__(self, concurrency, queue):
+		self.concurrency = concurrency
+		self.queue = queue
+		self.active = 0
+		self.waiting = collections.deque()
+		self.lock = threading.Lock()
+
+	def acquire(self, timeout=None):
+		"""
+		Takes a slot, waiting in line for at most *timeout* seconds if none
+		is free. Returns ``False`` right away if the line is full, and after
+		*timeout* seconds if no slot came free in time.
+		"""
+		with self.lock:
+			if self.active < self.concurrency and not self.waiting:
+				self.active += 1
+				return True
+			if len(self.waiting) >= self.queue:
+				return False
+			turn = threading.Event()
+			self.waiting.append(turn)
+
+		if turn.wait(timeout):
+			return True
+
+		with self.lock:
+			# The slot may have been handed to us right after we gave up.
+			if turn.is_set():
+				return True
+			self.waiting.remove(turn)
+			return False
+
+	def release(self):
+		"""
+		Frees a slot, handing it straight to the next one in line if any.
+		"""
+		with self.lock:
+			if self.waiting:
+				self.waiting.popleft().set()
+			else:
+				self.active -= 1
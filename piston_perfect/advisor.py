@@ -0,0 +1,163 @@
+"""
+Index advice based on the combinations of filters and ordering that clients
+actually use. See :attr:`.handlers.ModelHandler.advise_indexes`.
+
+Samples are kept in Django's cache, so that they are collected across
+processes and can be reported on by the ``piston_index_advice`` management
+command. The following settings attribute applies:
+
+   PISTON_ADVISOR_TTL = 604800    # Seconds a sample is kept (a week).
+
+For every combination, the query of the first sample (per process) is run
+through ``EXPLAIN`` in a background thread. Combinations whose plan has a
+full table scan or a sort on the handler's table are index candidates. They
+are ranked by the number of samples times the planner's cost estimate (which
+is only available on PostgreSQL; the number of examined rows is used on
+MySQL, and every query costs the same on SQLite).
+"""
+
+import hashlib, re, threading
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, models
+from django.db.models.sql.datastructures import EmptyResultSet
+from .utils import get_pool, in_thread
+
+
+KEYS = 'piston:advisor:keys'
+
+_explained = set()
+_lock = threading.Lock()
+
+def ttl():
+	return getattr(settings, 'PISTON_ADVISOR_TTL', 7 * 24 * 60 * 60)
+
+def record(handler, filters, order, sliced, data):
+	"""
+	Records a sample of the *QuerySet* *data* of handler type *handler*, which
+	is the result of applying filter definitions *filters* and ordering
+	*order*.
+	"""
+	filters = tuple(sorted([isinstance(definition, basestring) and definition or tuple(definition)
+		for definition in filters]))
+	signature = '%s.%s' % (handler.__module__, handler.__name__), filters, tuple(order), bool(sliced)
+	key = 'piston:advisor:%s' % hashlib.md5(repr(signature)).hexdigest()
+
+	if not cache.add(key + ':count', 1, ttl()):
+		try:
+			cache.incr(key + ':count')
+		except ValueError:
+			# Expired in the meantime.
+			pass
+
+	with _lock:
+		if key in _explained:
+			return
+		_explained.add(key)
+
+	try:
+		sql, params = data.query.get_compiler(data.db).as_sql()
+	except EmptyResultSet:
+		return
+
+	get_pool('advisor', 1).apply_async(in_thread(explain),
+		(key, signature, data.model, data.db, sql, params))
+
+def explain(key, signature, model, db, sql, params):
+	"""
+	Runs ``EXPLAIN`` on query *sql* and stores what it tells us about the
+	use of indexes on the table of *model*.
+	"""
+	connection = connections[db]
+	table = model._meta.db_table
+	cursor = connection.cursor()
+
+	if connection.vendor == 'postgresql':
+		cursor.execute('EXPLAIN ' + sql, params)
+		plan = '\n'.join([row[0] for row in cursor.fetchall()])
+		match = re.search(r'cost=[\d.]+\.\.([\d.]+)', plan)
+		cost = match and float(match.group(1)) or 0.0
+		scan = re.search(r'Seq Scan on "?%s"?\b' % re.escape(table), plan) is not None
+		sort = re.search(r'\bSort\b', plan) is not None
+
+	elif connection.vendor == 'mysql':
+		cursor.execute('EXPLAIN ' + sql, params)
+		columns = [column[0] for column in cursor.description]
+		rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+		cost = float(sum([row['rows'] or 0 for row in rows]))
+		own = [row for row in rows if row['table'] == table]
+		scan = any([row['type'] == 'ALL' for row in own])
+		sort = any(['filesort' in (row['Extra'] or '') for row in own])
+
+	elif connection.vendor == 'sqlite':
+		cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+		plan = [row[-1] for row in cursor.fetchall()]
+		cost = 1.0
+		scan = any([re.match(r'SCAN (TABLE )?%s\b' % re.escape(table), line) and not 'USING' in line
+			for line in plan])
+		sort = any(['TEMP B-TREE' in line for line in plan])
+
+	else:
+		return
+
+	handler, filters, order, sliced = signature
+
+	cache.set(key, dict(
+		handler=handler,
+		table=table,
+		filters=filters,
+		order=order,
+		sliced=sliced,
+		columns=candidate_columns(model, filters, order),
+		cost=cost,
+		scan=scan,
+		sort=sort,
+		sql=sql,
+		params=repr(tuple(params)),
+	), ttl())
+
+	keys = cache.get(KEYS) or []
+	if not key in keys:
+		cache.set(KEYS, keys + [key], ttl())
+
+def candidate_columns(model, filters, order):
+	"""
+	Returns the columns on the table of *model* that an index for filter
+	definitions *filters* and ordering *order* should cover, in order:
+	filtered columns first, then ordered columns. Search filters (on a list
+	of fields) are left out, as they do not benefit from a regular index.
+	"""
+	columns = []
+	for path in [definition for definition in filters if isinstance(definition, basestring)] + \
+		[field.lstrip('-') for field in order]:
+		try:
+			field = model._meta.get_field(path.split('__')[0], many_to_many=False)
+		except models.FieldDoesNotExist:
+			continue
+		if not field.column in columns:
+			columns.append(field.column)
+	return columns
+
+def report():
+	"""
+	Returns the index candidates, highest ranking first. Every candidate is a
+	dictionary with the data stored by :func:`explain`, plus the number of
+	samples (``count``) and the ranking ``score``.
+	"""
+	candidates = []
+	for key in cache.get(KEYS) or []:
+		entry = cache.get(key)
+		if entry is None or not (entry['scan'] or entry['sort']) or not entry['columns']:
+			continue
+		count = cache.get(key + ':count') or 0
+		candidates.append(dict(entry, count=count, score=count * entry['cost']))
+	return sorted(candidates, key=lambda candidate: -candidate['score'])
+
+def clear():
+	"""
+	Discards all samples.
+	"""
+	keys = cache.get(KEYS) or []
+	cache.delete_many(keys + [key + ':count' for key in keys] + [KEYS])
+	with _lock:
+		_explained.clear()
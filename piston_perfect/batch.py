@@ -0,0 +1,194 @@
+"""
+Multiplexing of several API requests into one.
+"""
+
+import urllib
+from django.core.exceptions import ValidationError
+from django.core.urlresolvers import resolve, Resolver404
+from django.db import transaction
+from django.test.client import RequestFactory
+from django.utils import simplejson
+from .handlers import BaseHandler
+from .resource import Resource
+from .utils import get_pool, in_thread
+
+
+class BatchAborted(Exception):
+	pass
+
+
+class BatchHandler(BaseHandler):
+	"""
+	Accepts an array of sub-requests in a ``POST`` request body and dispatches
+	them in-process to the resources they are addressed to, which saves a
+	client the overhead of a full HTTP request (including session handling)
+	for each of them. Every sub-request is an object of the form::
+
+		{
+			"method": "GET",
+			"path": "/api/contacts/",
+			"query": "filter=foo&slice=0:20",
+			"body": null
+		}
+
+	in which only *path* is required. *query* may also be given as an object,
+	in which case a list value denotes a repeated parameter. The response
+	data is an array with one result object per sub-request, in the same
+	order, each carrying the sub-request's ``status`` and its response data
+	(or ``errors``).
+	
+	Sub-requests are served by :meth:`.resource.Resource.serve`, so they are
+	subject to everything a request of their own would be subject to:
+	authentication, admission control, query budgets, replica routing and
+	exports. They are always served as JSON, are never compressed (the batch
+	response as a whole may be), and are not captured separately (see
+	:mod:`.capture`). Batches cannot be nested.
+	"""
+
+	request_fields = False
+
+	atomic = 'atomic'
+	"""
+	Query string parameter that, if present, makes all sub-requests run
+	sequentially inside a single database transaction. A sub-request that
+	fails rolls back the entire batch, and the sub-requests that were still
+	pending are reported as not executed (status ``424``). Define as ``False``
+	to disable transactional batches.
+	"""
+
+	max_size = 50
+	"""
+	The maximum number of sub-requests that will be accepted in one batch.
+	"""
+
+	concurrency = 4
+	"""
+	The number of threads that independent read (``GET``) sub-requests are
+	distributed over, or ``0`` to run everything in the request thread. As
+	every thread needs a database connection of its own, this value puts an
+	upper bound on the number of additional connections a batch can occupy.
+	The pool is shared by all batch handlers in the process.
+	
+	Note that outside of an :attr:`.atomic` batch there is no ordering
+	guarantee between reads and the other sub-requests, so a read should not
+	depend on a write in the same batch.
+	"""
+
+	def validate(self, request, *args, **kwargs):
+		"""
+		Makes sure that the request body is an array of sub-request
+		specifications.
+		"""
+		if not isinstance(request.data, list):
+			raise ValidationError("Request body should be an array of sub-requests.")
+
+		if len(request.data) > self.max_size:
+			raise ValidationError("Batch contains more than %d sub-requests." % self.max_size)
+
+		for spec in request.data:
+			if not isinstance(spec, dict) or not spec.get('path'):
+				raise ValidationError("Every sub-request should specify a path.")
+
+	def sub_request(self, request, spec):
+		"""
+		Returns a tuple of the resource that should handle the sub-request
+		specified by *spec*, the request object to give to it, and the
+		positional and keyword arguments from its URL pattern. The request
+		object shares the headers, user and session of *request*, so that it
+		is authenticated the same way.
+		"""
+		path, _, query = spec['path'].partition('?')
+
+		match = resolve(path)
+		if not isinstance(match.func, Resource) or isinstance(match.func.handler, BatchHandler):
+			raise Resolver404(path)
+
+		query = spec.get('query', query) or ''
+		if isinstance(query, dict):
+			query = urllib.urlencode(query, doseq=True)
+
+		# Content encoding is negotiated for the batch response only.
+		headers = dict([(key, value) for key, value in request.META.iteritems()
+			if key.startswith('HTTP_') and key != 'HTTP_ACCEPT_ENCODING'])
+		headers['QUERY_STRING'] = query
+		headers['REMOTE_ADDR'] = request.META.get('REMOTE_ADDR', '')
+
+		method = spec.get('method', 'GET').upper()
+		factory = getattr(RequestFactory(), method.lower())
+		if method in ('POST', 'PUT'):
+			sub = factory(path, simplejson.dumps(spec.get('body')), 'application/json', **headers)
+		else:
+			sub = factory(path, **headers)
+		sub.COOKIES = request.COOKIES
+		for attr in ('user', 'session'):
+			if hasattr(request, attr):
+				setattr(sub, attr, getattr(request, attr))
+
+		kwargs = dict(match.kwargs, emitter_format='json')
+		return match.func, sub, match.args, kwargs
+
+	def dispatch(self, request, spec):
+		"""
+		Serves the sub-request specified by *spec* through its resource, and
+		returns its status and response data. Never raises; problems are
+		reported in the returned result object instead.
+		"""
+		try:
+			resource, sub, args, kwargs = self.sub_request(request, spec)
+		except Resolver404:
+			return dict(status=404)
+
+		if not sub.method in resource.handler.allowed_methods:
+			return dict(status=405)
+
+		try:
+			response = resource.serve(sub, *args, **kwargs)
+			content = response.content
+		except Exception:
+			return dict(status=500)
+
+		result = dict(status=response.status_code)
+		try:
+			data = simplejson.loads(content)
+		except ValueError:
+			data = None
+		if isinstance(data, dict):
+			data.update(result)
+			return data
+		return result
+
+	def create(self, request, *args, **kwargs):
+		specs = request.data
+
+		if self.atomic and self.atomic in request.GET:
+			results = []
+			try:
+				with transaction.commit_on_success():
+					for spec in specs:
+						results.append(self.dispatch(request, spec))
+						if results[-1]['status'] >= 400:
+							raise BatchAborted
+			except BatchAborted:
+				pass
+			return results + [dict(status=424) for spec in specs[len(results):]]
+
+		results = [None] * len(specs)
+
+		# Reads are independent of each other, so they may run concurrently.
+		# Everything else runs in order, in the request thread, after the reads
+		# have been dispatched.
+		pending = {}
+		if self.concurrency:
+			pool = get_pool('batch', self.concurrency)
+			for i, spec in enumerate(specs):
+				if spec.get('method', 'GET').upper() == 'GET':
+					pending[i] = pool.apply_async(in_thread(self.dispatch), (request, spec))
+
+		for i, spec in enumerate(specs):
+			if not i in pending:
+				results[i] = self.dispatch(request, spec)
+
+		for i, result in pending.iteritems():
+			results[i] = result.get()
+
+		return results
@@ -0,0 +1,183 @@
+"""
+Per-request query budgets. See :attr:`.handlers.BaseHandler.max_queries`,
+:attr:`.handlers.BaseHandler.max_query_time` and
+:attr:`.handlers.BaseHandler.statement_timeout`.
+"""
+
+import threading, time
+from contextlib import contextmanager
+from django.db import connections, DatabaseError
+from .utils import QueryBudgetExceeded
+
+
+_local = threading.local()
+
+def current():
+	"""
+	Returns the budget that is in effect in the current thread, or ``None``.
+	"""
+	return getattr(_local, 'budget', None)
+
+
+class QueryBudget(object):
+	"""
+	Context manager that puts a budget on the database queries that are made
+	in the current thread while it is active. The budget is enforced by a
+	wrapper around every cursor, which raises
+	:exc:`.utils.QueryBudgetExceeded` as soon as a query would exceed the
+	maximum number of queries, or a query has made the total query time
+	exceed the maximum. In addition, a per-statement timeout is set on the
+	database side where the backend supports it (PostgreSQL and MySQL 5.7.8
+	and up), as that is the only way to stop a runaway query in its tracks.
+	
+	Budgets can be nested (as happens with batched requests, see
+	:class:`.batch.BatchHandler`), in which case a query counts against all
+	of them.
+	"""
+
+	def __init__(self, max_queries=None, max_time=None, statement_timeout=None):
+		self.max_queries = max_queries
+		self.max_time = max_time
+		self.statement_timeout = statement_timeout
+		self.queries = 0
+		self.time = 0.0
+		self.exempt = False
+		self.free = False
+		self.timed_out = set()
+		self.previous = None
+
+	def __enter__(self):
+		self.wrapped = []
+		if self.max_queries is None and self.max_time is None and not self.statement_timeout:
+			# Nothing to enforce, so don't bother.
+			return self
+		self.previous = current()
+		_local.budget = self
+		for connection in connections.all():
+			# Connections are thread-local, so this affects the current
+			# thread only. The cursor of an enclosing budget (if any) is
+			# wrapped, and put back afterwards.
+			self.wrapped.append((connection, connection.__dict__.get('cursor')))
+			connection.cursor = self.wrap(connection, connection.cursor)
+		return self
+
+	def __exit__(self, *exc_info):
+		if self.wrapped:
+			_local.budget = self.previous
+		for connection, cursor in self.wrapped:
+			if cursor is None:
+				del connection.cursor
+			else:
+				connection.cursor = cursor
+			if connection in self.timed_out and connection.connection is not None:
+				self.restore_timeout(connection)
+
+	def wrap(self, connection, cursor):
+		def wrapper():
+			if self.statement_timeout and not connection in self.timed_out:
+				self.timed_out.add(connection)
+				self.set_timeout(connection, self.statement_timeout)
+			return BudgetCursor(cursor(), self)
+		return wrapper
+
+	def restore_timeout(self, connection):
+		"""
+		Puts the statement timeout of *connection* back to what it was before
+		this budget (that of an enclosing budget, or none). A statement that
+		ran into the timeout leaves a PostgreSQL transaction aborted, and
+		nothing can be done in it until it is rolled back. If even that does
+		not help, the connection is closed, so that the timeout does not
+		linger in its session.
+		"""
+		previous = self.previous
+		timeout = None
+		if previous is not None and connection in previous.timed_out:
+			timeout = previous.statement_timeout
+		try:
+			self.set_timeout(connection, timeout)
+		except DatabaseError:
+			try:
+				connection._rollback()
+				self.set_timeout(connection, timeout)
+			except DatabaseError:
+				connection.close()
+
+	def set_timeout(self, connection, timeout):
+		"""
+		Sets (or with a *timeout* of ``None``, resets) the statement timeout
+		on the database side, if the backend of *connection* supports it.
+		"""
+		# Bypasses the budgets, as this is none of their business.
+		cursor = type(connection).cursor(connection)
+		vendor = getattr(connection, 'vendor', None)
+		if vendor == 'postgresql':
+			cursor.execute(timeout and 'SET statement_timeout = %d' % (timeout * 1000) or 'RESET statement_timeout')
+		elif vendor == 'mysql':
+			try:
+				cursor.execute('SET SESSION max_execution_time = %d' % (timeout and timeout * 1000 or 0))
+			except DatabaseError:
+				# Not supported by this version of MySQL.
+				pass
+
+	def charge(self, start):
+		if self.free:
+			return
+		self.queries += 1
+		self.time += time.time() - start
+
+	def check_queries(self):
+		if not self.exempt and self.max_queries is not None and self.queries >= self.max_queries:
+			raise QueryBudgetExceeded("More than %d queries." % self.max_queries)
+
+	def check_time(self):
+		if not self.exempt and self.max_time is not None and self.time > self.max_time:
+			raise QueryBudgetExceeded("More than %s seconds of query time." % self.max_time)
+
+	@contextmanager
+	def exemption(self, charge=True):
+		"""
+		Context manager in which queries are counted (unless *charge* is
+		``False``), but not checked against the budget. Useful for a cheap
+		fallback for a query that exceeded the budget, and for bookkeeping
+		queries that should not count.
+		"""
+		previous = self.exempt, self.free
+		self.exempt, self.free = True, self.free or not charge
+		try:
+			yield
+		finally:
+			self.exempt, self.free = previous
+
+
+class BudgetCursor(object):
+
+	def __init__(self, cursor, budget):
+		self.cursor = cursor
+		self.budget = budget
+
+	def run(self, method, *args):
+		self.budget.check_queries()
+		start = time.time()
+		try:
+			result = method(*args)
+		except DatabaseError:
+			self.budget.charge(start)
+			# A statement that ran into the database-side timeout.
+			if self.budget.statement_timeout and time.time() - start >= self.budget.statement_timeout:
+				raise QueryBudgetExceeded("Query took more than %s seconds." % self.budget.statement_timeout)
+			raise
+		self.budget.charge(start)
+		self.budget.check_time()
+		return result
+
+	def execute(self, sql, params=()):
+		return self.run(self.cursor.execute, sql, params)
+
+	def executemany(self, sql, param_list):
+		return self.run(self.cursor.executemany, sql, param_list)
+
+	def __getattr__(self, attr):
+		return getattr(self.cursor, attr)
+
+	def __iter__(self):
+		return iter(self.cursor)
@@ -0,0 +1,246 @@
+"""
+Cross-request caching of model instances of small, frequently nested models
+(think lists, users, tags), see :attr:`.handlers.ModelHandler.cacheable`, and
+of constructed representations of model instances, see
+:attr:`.handlers.ModelHandler.fragment_cache`.
+
+The following settings attributes apply:
+
+   PISTON_OBJECT_CACHE_SIZE = 1000      # Instances per process.
+   PISTON_OBJECT_CACHE_TTL = 60         # Seconds.
+   PISTON_OBJECT_CACHE_SHARED = False   # Use Django's cache as second tier.
+   PISTON_FRAGMENT_CACHE_TTL = 300      # Seconds.
+   PISTON_FRAGMENT_CACHE_SIZE = 1000    # Fragments per process.
+
+Every cacheable model has a version that is bumped whenever one of its
+instances is saved or deleted, which invalidates all cached instances of that
+model. Without the shared tier, the version is local to the process, so other
+processes only notice the change once their copies expire after
+``PISTON_OBJECT_CACHE_TTL`` seconds. With the shared tier, the version is kept
+in Django's cache, so all processes notice right away. A shared version that
+gets lost (it is kept for a year, but may be evicted before that) starts
+over at the current time in milliseconds, which is beyond any version it
+may have had before.
+
+Constructed representations (fragments) are kept in Django's cache if they
+are keyed on a version that all processes agree on: the value of a field
+(see :attr:`.handlers.ModelHandler.fragment_version`) or a shared model
+version. Fragments that are keyed on a local model version are kept in the
+process, alongside the instances, as the same version number means
+different things in different processes.
+"""
+
+import copy, hashlib, threading, time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+
+
+VERSION_TTL = 365 * 24 * 60 * 60
+
+def copy_instance(instance):
+	"""
+	Returns a copy of model *instance* that has a state of its own.
+	"""
+	clone = copy.copy(instance)
+	clone._state = copy.deepcopy(instance._state)
+	return clone
+
+
+class ObjectCache(object):
+	"""
+	Process-local LRU cache of model instances, keyed by model type, version
+	and primary key, optionally backed by Django's cache.
+	"""
+
+	def __init__(self):
+		self.models = set()
+		self.versions = {}
+		self.entries = OrderedDict()
+		self.fragments = OrderedDict()
+		self.lock = threading.Lock()
+
+	def size(self):
+		return getattr(settings, 'PISTON_OBJECT_CACHE_SIZE', 1000)
+
+	def ttl(self):
+		return getattr(settings, 'PISTON_OBJECT_CACHE_TTL', 60)
+
+	def shared(self):
+		return getattr(settings, 'PISTON_OBJECT_CACHE_SHARED', False)
+
+	def register(self, model):
+		"""
+		Makes instances of *model* cacheable, and has them invalidated when
+		any of them is saved or deleted.
+		"""
+		self.models.add(model)
+		self.track(model)
+
+	def track(self, model):
+		"""
+		Has the version of *model* bumped whenever any of its instances is
+		saved or deleted.
+		"""
+		# Connecting is idempotent thanks to *dispatch_uid*.
+		uid = 'piston:%s' % model._meta.db_table
+		post_save.connect(self.invalidate, sender=model, weak=False, dispatch_uid=uid)
+		post_delete.connect(self.invalidate, sender=model, weak=False, dispatch_uid=uid)
+
+	def is_cacheable(self, model):
+		return model in self.models
+
+	def version_key(self, model):
+		return 'piston:version:%s' % model._meta.db_table
+
+	def object_key(self, model, version, pk):
+		return 'piston:object:%s:%s:%s' % (model._meta.db_table, version, pk)
+
+	def version(self, model):
+		if self.shared():
+			version = cache.get(self.version_key(model))
+			if version is None:
+				self.restart(model)
+				version = cache.get(self.version_key(model))
+			return version
+		return self.versions.get(model, 0)
+
+	def restart(self, model):
+		# Only one process gets to start the version over, the others use
+		# the one it started.
+		cache.add(self.version_key(model), int(time.time() * 1000), VERSION_TTL)
+
+	def invalidate(self, sender, **kwargs):
+		"""
+		Signal receiver that bumps the version of model type *sender*.
+		"""
+		if self.shared():
+			try:
+				cache.incr(self.version_key(sender))
+			except ValueError:
+				# A version that is lost starts over beyond where it was.
+				self.restart(sender)
+			return
+		with self.lock:
+			self.versions[sender] = self.versions.get(sender, 0) + 1
+
+	def get_many(self, model, pks):
+		"""
+		Returns a dictionary of the instances of *model* with primary keys
+		*pks* that are in cache. Every instance is a copy, so that whatever
+		a request does to it does not leak into others.
+		"""
+		version = self.version(model)
+		now = time.time()
+		found = {}
+
+		with self.lock:
+			for pk in pks:
+				key = model, version, pk
+				entry = self.entries.get(key)
+				if entry is None:
+					continue
+				if entry[0] < now:
+					del self.entries[key]
+					continue
+				# Mark as most recently used.
+				del self.entries[key]
+				self.entries[key] = entry
+				found[pk] = entry[1]
+
+		missing = [pk for pk in pks if not pk in found]
+		if missing and self.shared():
+			keys = dict([(self.object_key(model, version, pk), pk) for pk in missing])
+			shared = cache.get_many(keys.keys())
+			self.store(model, version, dict([(keys[key], instance) for key, instance in shared.iteritems()]), now)
+			for key, instance in shared.iteritems():
+				found[keys[key]] = instance
+
+		return dict([(pk, copy_instance(instance)) for pk, instance in found.iteritems()])
+
+	def set_many(self, model, instances):
+		"""
+		Caches *instances* of *model*. They should be fresh from the
+		database, without any related instances attached.
+		"""
+		version = self.version(model)
+		instances = dict([(instance.pk, copy_instance(instance)) for instance in instances])
+		self.store(model, version, instances, time.time())
+		if self.shared():
+			cache.set_many(dict([(self.object_key(model, version, pk), instance)
+				for pk, instance in instances.iteritems()]), self.ttl())
+
+	def store(self, model, version, instances, now):
+		with self.lock:
+			for pk, instance in instances.iteritems():
+				self.entries[model, version, pk] = now + self.ttl(), instance
+			while len(self.entries) > self.size():
+				self.entries.popitem(last=False)
+
+	def get_fragments(self, keys):
+		"""
+		Returns a dictionary of the fragments with keys *keys* that are in
+		the process-local fragment store.
+		"""
+		now = time.time()
+		found = {}
+		with self.lock:
+			for key in keys:
+				entry = self.fragments.pop(key, None)
+				if entry is None or entry[0] < now:
+					continue
+				# Marks as most recently used.
+				self.fragments[key] = entry
+				found[key] = entry[1]
+		return found
+
+	def set_fragments(self, fragments):
+		"""
+		Keeps *fragments* (a dictionary by key) in the process-local fragment
+		store.
+		"""
+		expires = time.time() + fragment_ttl()
+		size = getattr(settings, 'PISTON_FRAGMENT_CACHE_SIZE', 1000)
+		with self.lock:
+			for key, fragment in fragments.iteritems():
+				self.fragments.pop(key, None)
+				self.fragments[key] = expires, fragment
+			while len(self.fragments) > size:
+				self.fragments.popitem(last=False)
+
+
+object_cache = ObjectCache()
+
+
+def fragment_key(handler, instance, version, fields):
+	"""
+	Returns the cache key of the constructed representation of *instance*
+	by the handler type *handler* with the fields specification *fields*,
+	at version *version*.
+	"""
+	return 'piston:fragment:%s.%s:%s:%s:%s:%s' % (
+		handler.__module__, handler.__name__,
+		instance._meta.db_table,
+		instance.pk,
+		hashlib.md5(unicode(version).encode('utf-8')).hexdigest(),
+		hashlib.md5(repr(fields)).hexdigest(),
+	)
+
+def fragment_ttl():
+	return getattr(settings, 'PISTON_FRAGMENT_CACHE_TTL', 300)
+
+def get_fragments(keys, local=False):
+	"""
+	Returns a dictionary of the fragments with keys *keys* that are in
+	cache: the process-local store if *local*, or Django's cache otherwise.
+	"""
+	if local:
+		return object_cache.get_fragments(keys)
+	return cache.get_many(keys)
+
+def set_fragments(fragments, local=False):
+	if local:
+		object_cache.set_fragments(fragments)
+	else:
+		cache.set_many(fragments, fragment_ttl())
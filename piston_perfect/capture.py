@@ -0,0 +1,109 @@
+"""
+Capture of API traffic, for replay by the ``piston_replay`` management
+command (see :mod:`.replay`). The following settings attributes apply:
+
+   PISTON_CAPTURE_LOG = None      # Path of the log file; None disables.
+   PISTON_CAPTURE_SAMPLE = 1      # Fraction of requests to capture.
+   PISTON_CAPTURE_REDACT = ('password', 'token', 'secret', 'key', 'api_key')
+
+Every captured request is appended to the log as a line of JSON, with the
+handler type, method, URL arguments, query string, the shape of the request
+body and the response's status, duration and number of database queries
+(the latter only if ``DEBUG`` is on). Query string parameters whose name is
+in ``PISTON_CAPTURE_REDACT`` have their values masked, and request bodies
+are reduced to their shape: the keys and the types of the values, but not
+the values themselves.
+
+Captured lines are buffered and written to the log by a background thread,
+so requests do not wait for the disk. Lines that are still buffered when the
+process exits are lost.
+"""
+
+import random, threading, time
+from django.conf import settings
+from django.db import connection
+from django.utils import simplejson
+from .utils import get_pool
+
+
+REDACTED = '***'
+
+_buffers = {}
+_lock = threading.Lock()
+
+def log_path():
+	return getattr(settings, 'PISTON_CAPTURE_LOG', None)
+
+def sample():
+	return getattr(settings, 'PISTON_CAPTURE_SAMPLE', 1)
+
+def redact():
+	return getattr(settings, 'PISTON_CAPTURE_REDACT', ('password', 'token', 'secret', 'key', 'api_key'))
+
+def shape(data):
+	"""
+	Returns the shape of request body *data*: dictionaries and lists with all
+	other values replaced by the name of their type. Lists are reduced to
+	the shape of their first item and their length.
+	"""
+	if isinstance(data, dict):
+		return dict([(key, shape(value)) for key, value in data.iteritems()])
+	if isinstance(data, (list, tuple)):
+		return dict(items=data and shape(data[0]) or None, length=len(data))
+	return type(data).__name__
+
+def record(handler, request, args, kwargs, response, duration):
+	"""
+	Appends a capture of *request* on handler type *handler*, which resulted
+	in *response* in *duration* seconds, to the log.
+	"""
+	path = log_path()
+	if not path or random.random() >= sample():
+		return
+
+	redacted = redact()
+	query = [(key, key in redacted and REDACTED or value)
+		for key, values in request.GET.iterlists()
+		for value in values]
+
+	line = simplejson.dumps(dict(
+		time=time.time(),
+		handler='%s.%s' % (handler.__module__, handler.__name__),
+		method=request.method.upper(),
+		path=request.path,
+		args=args,
+		kwargs=kwargs,
+		query=query,
+		content_type=request.META.get('CONTENT_TYPE'),
+		body=getattr(request, 'body_shape', None),
+		status=response.status_code,
+		duration=duration,
+		queries=settings.DEBUG and len(connection.queries) or None,
+	), default=unicode)
+
+	with _lock:
+		buffer = _buffers.setdefault(path, [])
+		buffer.append(line + '\n')
+		# A flush that is pending already takes this line along.
+		pending = len(buffer) > 1
+	if not pending:
+		get_pool('capture', 1).apply_async(flush, (path,))
+
+def flush(path):
+	"""
+	Appends the lines that are buffered for the log at *path* to it.
+	"""
+	with _lock:
+		lines = _buffers.pop(path, [])
+	if lines:
+		with open(path, 'a') as f:
+			f.write(''.join(lines))
+
+def load(path):
+	"""
+	Yields the captured requests from the log at *path*.
+	"""
+	with open(path) as f:
+		for line in f:
+			if line.strip():
+				yield simplejson.loads(line)
@@ -0,0 +1,155 @@
+"""
+Negotiated compression of response bodies, both regular and streaming. Is
+used by :meth:`.resource.Resource.serve`.
+
+The following settings attributes apply:
+
+   PISTON_COMPRESS_MIN_SIZE = 1024          # Don't bother below this size.
+   PISTON_COMPRESS_FORMATS = 'json', 'html', 'excel',
+
+``gzip`` is always available. If the :mod:`zstandard` package is installed,
+``zstd`` is offered as well, and preferred over ``gzip`` by clients that
+accept both, as it is considerably cheaper in CPU time. Neither is imported
+until the first response is compressed.
+"""
+
+import time
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from .signals import response_compressed
+
+
+def gzip_compressor():
+	import zlib
+	# A *wbits* value of 16 + MAX_WBITS makes zlib write a gzip container.
+	return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+def zstd_compressor():
+	import zstandard
+	return zstandard.ZstdCompressor(level=3).compressobj()
+
+_codecs = None
+
+def get_codecs():
+	"""
+	Returns the available codecs in order of preference, as tuples of the
+	encoding name, a function that returns a compressor, and the argument to
+	a compressor's *flush* that yields all data so far without ending the
+	stream.
+	"""
+	global _codecs
+	if _codecs is None:
+		import zlib
+		codecs = [('gzip', gzip_compressor, zlib.Z_SYNC_FLUSH)]
+		try:
+			import zstandard
+		except ImportError:
+			pass
+		else:
+			codecs.insert(0, ('zstd', zstd_compressor, zstandard.COMPRESSOBJ_FLUSH_BLOCK))
+		_codecs = codecs
+	return _codecs
+
+
+def negotiate(request):
+	"""
+	Returns the entry in :func:`get_codecs` of the best encoding that the
+	client accepts according to its ``Accept-Encoding`` header, or ``None``.
+	"""
+	accepted = {}
+	for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+		name, _, params = part.partition(';')
+		name = name.strip().lower()
+		q = 1.0
+		params = params.strip()
+		if params.startswith('q='):
+			try:
+				q = float(params[2:])
+			except ValueError:
+				q = 0.0
+		if name:
+			accepted[name] = q
+
+	best = None
+	for codec in get_codecs():
+		q = accepted.get(codec[0], accepted.get('*', 0.0))
+		if q > 0 and (best is None or q > best[0]):
+			best = q, codec
+
+	return best and best[1]
+
+def compress(request, response, em_format, sender):
+	"""
+	Compresses the body of *response* in place if the client accepts it and
+	the response qualifies, which is the case for successful responses in one
+	of the ``PISTON_COMPRESS_FORMATS`` that are not encoded already and are
+	either streaming or at least ``PISTON_COMPRESS_MIN_SIZE`` bytes long.
+	Sends :data:`.signals.response_compressed` with *sender* as its sender.
+	"""
+	if response.status_code != 200 or response.has_header('Content-Encoding'):
+		return response
+
+	if not em_format in getattr(settings, 'PISTON_COMPRESS_FORMATS', ('json', 'html', 'excel')):
+		return response
+
+	# Django 1.3 offers no public interface to tell streaming responses apart
+	# or to replace their content iterator.
+	streaming = not response._is_string
+
+	if not streaming and len(response.content) < getattr(settings, 'PISTON_COMPRESS_MIN_SIZE', 1024):
+		return response
+
+	# Whether or not we compress, the response depends on this header.
+	patch_vary_headers(response, ('Accept-Encoding',))
+
+	codec = negotiate(request)
+	if not codec:
+		return response
+	encoding, factory, sync = codec
+
+	def report(size, compressed_size, cpu_time):
+		response_compressed.send(sender=sender, request=request, encoding=encoding,
+			size=size, compressed_size=compressed_size, cpu_time=cpu_time)
+
+	if streaming:
+		response._container = compress_stream(response._container, factory(), sync, report)
+	else:
+		start = time.clock()
+		compressor = factory()
+		content = response.content
+		response.content = compressor.compress(content) + compressor.flush()
+		report(len(content), len(response.content), time.clock() - start)
+
+	response['Content-Encoding'] = encoding
+	if response.has_header('Content-Length'):
+		del response['Content-Length']
+
+	return response
+
+def compress_stream(chunks, compressor, sync, report):
+	"""
+	Compresses the iterable *chunks* incrementally, flushing after every
+	chunk so that the client gets to see data as soon as it would have
+	without compression.
+	"""
+	size = compressed_size = 0
+	cpu_time = 0.0
+
+	for chunk in chunks:
+		if isinstance(chunk, unicode):
+			chunk = chunk.encode(settings.DEFAULT_CHARSET)
+		start = time.clock()
+		compressed = compressor.compress(chunk) + compressor.flush(sync)
+		cpu_time += time.clock() - start
+		size += len(chunk)
+		compressed_size += len(compressed)
+		if compressed:
+			yield compressed
+
+	start = time.clock()
+	compressed = compressor.flush()
+	cpu_time += time.clock() - start
+	compressed_size += len(compressed)
+	yield compressed
+
+	report(size, compressed_size, cpu_time)
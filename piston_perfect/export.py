@@ -0,0 +1,241 @@
+"""
+Exports that run in the background. See :attr:`.handlers.BaseHandler.export`.
+The following settings attributes apply:
+
+   PISTON_EXPORT_DIR = None       # Defaults to a directory in /tmp.
+   PISTON_EXPORT_THREADS = 2      # Number of exports that run at once.
+   PISTON_EXPORT_TTL = 3600       # Seconds a finished export is kept.
+
+Exports are kept on disk, so that they can be downloaded through any process
+that shares the directory. For this to work, hook up :func:`download` in your
+URL patterns, as in::
+
+   url(r'^exports/(?P<job>\\w+)$', 'piston_perfect.export.download'),
+
+An export is identified by the :class:`.spec.RequestSpec` of the request that
+started it, so requesting the same export while it is running (or while it is
+kept) does not start another one. Its identifier is derived from the spec
+with ``SECRET_KEY``, so that it cannot be guessed, and an export that was
+started by an authenticated user can only be downloaded by that same user.
+"""
+
+import copy, hashlib, os, re, time
+from wsgiref.util import FileWrapper
+from django.conf import settings
+from django.core.urlresolvers import reverse, NoReverseMatch
+from django.http import HttpResponse, HttpResponseNotFound
+from django.utils import simplejson
+from .spec import RequestSpec
+from .utils import get_pool, in_thread
+
+
+def directory():
+	path = getattr(settings, 'PISTON_EXPORT_DIR', None)
+	if not path:
+		import tempfile
+		path = os.path.join(tempfile.gettempdir(), 'piston-exports')
+	if not os.path.isdir(path):
+		try:
+			os.makedirs(path)
+		except OSError:
+			# Created by someone else in the meantime.
+			pass
+	return path
+
+def ttl():
+	return getattr(settings, 'PISTON_EXPORT_TTL', 60 * 60)
+
+def status_path(job):
+	return os.path.join(directory(), '%s.json' % job)
+
+def data_path(job):
+	return os.path.join(directory(), '%s.data' % job)
+
+def read_status(job):
+	"""
+	Returns the status of export *job*, or ``None`` if there is no such
+	export (anymore).
+	"""
+	try:
+		if time.time() - os.path.getmtime(status_path(job)) > ttl():
+			return None
+		with open(status_path(job)) as f:
+			return simplejson.load(f)
+	except (OSError, IOError):
+		return None
+	except ValueError:
+		# Has just been claimed, and its status is yet to be written.
+		return dict(status='running')
+
+def write_status(job, **status):
+	# Written to a temporary file first, so that readers never see a
+	# partially written status.
+	path = status_path(job)
+	with open(path + '.tmp', 'w') as f:
+		simplejson.dump(status, f)
+	os.rename(path + '.tmp', path)
+
+def claim(job, owner):
+	"""
+	Returns ``True`` if export *job* was not running or kept yet, and is now
+	ours to run on behalf of *owner*.
+	"""
+	status = read_status(job)
+	if status is None or status['status'] == 'failed':
+		remove(job)
+	try:
+		os.close(os.open(status_path(job), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+	except OSError:
+		return False
+	write_status(job, status='running', owner=owner)
+	return True
+
+def get_owner(request):
+	"""
+	Returns the primary key of the user that *request* is made by, or
+	``None`` if it is anonymous.
+	"""
+	user = getattr(request, 'user', None)
+	return user is not None and user.is_authenticated() and user.pk or None
+
+def remove(job):
+	for path in status_path(job), data_path(job):
+		try:
+			os.remove(path)
+		except OSError:
+			pass
+
+def sweep():
+	"""
+	Removes the exports that have expired.
+	"""
+	now = time.time()
+	for name in os.listdir(directory()):
+		match = re.match(r'^(\w+)\.json$', name)
+		if match and now - os.path.getmtime(os.path.join(directory(), name)) > ttl():
+			remove(match.group(1))
+
+def status_response(job, status, code=202):
+	response = HttpResponse(simplejson.dumps(dict(job=job, status=status)),
+		content_type='application/json; charset=utf-8', status=code)
+	try:
+		response['Location'] = reverse('piston_perfect.export.download', args=(job, ))
+	except NoReverseMatch:
+		pass
+	return response
+
+
+def start(resource, request, *args, **kwargs):
+	"""
+	Starts exporting the response to *request* on *resource* in the
+	background, unless the same export is already running or available.
+	Returns a ``202 Accepted`` response that tells the client where to find
+	it.
+	"""
+	import hmac
+	job = hmac.new(settings.SECRET_KEY,
+		RequestSpec.from_request(resource, request, *args, **kwargs).key(),
+		hashlib.sha1).hexdigest()
+	owner = get_owner(request)
+
+	if claim(job, owner):
+		sweep()
+
+		# The export itself is produced by a copy of the request that does not
+		# ask for an export.
+		export = copy.copy(request)
+		export.GET = request.GET.copy()
+		del export.GET[resource.handler.export]
+
+		threads = getattr(settings, 'PISTON_EXPORT_THREADS', 2)
+		get_pool('export', threads).apply_async(in_thread(run), (job, owner, resource, export) + args, kwargs)
+
+	return status_response(job, (read_status(job) or {}).get('status', 'running'))
+
+def run(job, owner, resource, request, *args, **kwargs):
+	try:
+		response = resource.respond(request, *args, **kwargs)
+		if response.status_code != 200:
+			write_status(job, status='failed', owner=owner, code=response.status_code)
+			return
+
+		with open(data_path(job) + '.tmp', 'wb') as f:
+			for chunk in response:
+				f.write(chunk)
+		os.rename(data_path(job) + '.tmp', data_path(job))
+
+		write_status(job, status='done', owner=owner,
+			content_type=response.get('Content-Type'),
+			disposition=response.get('Content-Disposition'),
+		)
+	except Exception:
+		write_status(job, status='failed', owner=owner, code=500)
+		raise
+
+def download(request, job):
+	"""
+	View that tells the status of export *job*, or serves the exported data
+	once it is done. Supports single ``Range`` requests, so that interrupted
+	downloads can be resumed. An export that belongs to someone else does
+	not exist as far as this view is concerned.
+	"""
+	status = read_status(job)
+	if status is None:
+		return HttpResponseNotFound()
+
+	if status.get('owner') is not None and status['owner'] != get_owner(request):
+		return HttpResponseNotFound()
+
+	if status['status'] != 'done':
+		return status_response(job, status['status'],
+			status['status'] == 'running' and 202 or 500)
+
+	path = data_path(job)
+	size = os.path.getsize(path)
+	start, stop = 0, size - 1
+
+	match = re.match(r'^bytes=(\d*)-(\d*)$', request.META.get('HTTP_RANGE', ''))
+	if match and any(match.groups()):
+		if match.group(1):
+			start = int(match.group(1))
+			stop = match.group(2) and min(int(match.group(2)), size - 1) or size - 1
+		else:
+			# A suffix range, as in the last *n* bytes.
+			start = max(size - int(match.group(2)), 0)
+		if start > stop:
+			response = HttpResponse(status=416)
+			response['Content-Range'] = 'bytes */%d' % size
+			return response
+
+	f = open(path, 'rb')
+	f.seek(start)
+	response = HttpResponse(FileWrapper(LimitedFile(f, stop - start + 1)),
+		content_type=status['content_type'] or 'application/octet-stream',
+		status=match and any(match.groups()) and 206 or 200)
+	response['Content-Length'] = str(stop - start + 1)
+	response['Accept-Ranges'] = 'bytes'
+	if response.status_code == 206:
+		response['Content-Range'] = 'bytes %d-%d/%d' % (start, stop, size)
+	if status['disposition']:
+		response['Content-Disposition'] = status['disposition']
+	return response
+
+
+class LimitedFile(object):
+	"""
+	Reads at most *length* bytes from file *f*.
+	"""
+
+	def __init__(self, f, length):
+		self.f = f
+		self.remaining = length
+
+	def read(self, size=-1):
+		if size < 0 or size > self.remaining:
+			size = self.remaining
+		data = self.f.read(size)
+		self.remaining -= len(data)
+		return data
+
+	def close(self):
+		self.f.close()
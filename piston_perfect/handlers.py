@@ -2,19 +2,179 @@
 Generic handlers.
 """
 
-import re
+import collections, itertools, random, re, sys, threading
 from django import forms
-from django.core.exceptions import ValidationError
-from django.db import models, connection
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db import models, connection, connections, transaction
 from django.conf import settings
+from django.utils.datastructures import SortedDict
+from functools import wraps
 from pistoff import handler, resource
+from . import advisor, profiling, routing
 from .authentication import DjangoAuthentication
+from .budget import QueryBudget, current as current_budget
+from .cache import object_cache
+from .ingest import Ingest
+from .models import Tombstone, model_label
 from .resource import Resource
-from .utils import MethodNotAllowed
+from .utils import MethodNotAllowed, QueryBudgetExceeded, get_pool, in_thread
 from django.core.exceptions import ValidationError
 from custom_filters import filter_to_method
 
 
+def fields_tree(paths):
+	"""
+	Translates a list of (dotted) field paths into Piston's notation for
+	nested fields selections, in which a field whose nested data is to be
+	selected is represented as a tuple of its name and the nested selection.
+	For example: ``('id', 'mailing.subject', 'mailing.sender.name')`` becomes
+	``('id', ('mailing', ('subject', ('sender', ('name', )))))``.
+	"""
+	tree = SortedDict()
+	for path in paths:
+		name, _, rest = path.partition('.')
+		tree.setdefault(name, [])
+		if rest:
+			tree[name].append(rest)
+	return tuple([subpaths and (name, fields_tree(subpaths)) or name
+		for name, subpaths in tree.items()])
+
+def handler_for_model(model):
+	"""
+	Returns the handler type that is registered in Piston's typemapper for
+	*model*, or ``None``.
+	"""
+	for klass, (mapped, anonymous) in handler.typemapper.iteritems():
+		if mapped is model:
+			return klass
+	return None
+
+def related_model(model, name):
+	"""
+	Returns the model that the relation named *name* on *model* refers to, or
+	``None`` if *name* is not a relation. Works for both directions.
+	"""
+	try:
+		field, _, direct, m2m = model._meta.get_field_by_name(name)
+	except models.FieldDoesNotExist:
+		return None
+	if not direct:
+		return field.model
+	return field.rel and field.rel.to or None
+
+def forward_paths(model, selection, prefix='', leaves=False):
+	"""
+	Returns the lookup paths (as in ``mailing__sender``) of all many-to-one
+	and one-to-one relations in the nested fields selection *selection* on
+	*model*, for use with *select_related*. Fields without a nested
+	selection are only considered if *leaves* is ``True``.
+	"""
+	paths = []
+	for field in selection:
+		if not isinstance(field, tuple):
+			if not leaves:
+				continue
+			field = field, ()
+		name, nested = field
+		try:
+			field = model._meta.get_field(name, many_to_many=False)
+		except models.FieldDoesNotExist:
+			continue
+		if isinstance(field, models.ForeignKey):
+			path = prefix + name
+			paths.extend(forward_paths(field.rel.to, nested, path + '__', leaves) or [path])
+	return paths
+
+def deferred_paths(model, selection, related, expanded=(), prefix=''):
+	"""
+	Returns the lookup paths (as in ``mailing__body``) of the fields of
+	related records that are not needed for the nested fields selection
+	*selection* on *model*, for use with *defer* alongside *select_related*
+	with paths *related*. A related record whose selection includes anything
+	other than plain fields (such as a method) is left alone, as we cannot
+	tell which fields that needs. So are the records on the paths in
+	*expanded*, which are needed in full.
+	"""
+	def covers(path, paths):
+		return any([other == path or other.startswith(path + '__') for other in paths])
+	
+	paths = []
+	for field in selection:
+		if not isinstance(field, tuple):
+			continue
+		name, nested = field
+		try:
+			field = model._meta.get_field(name, many_to_many=False)
+		except models.FieldDoesNotExist:
+			continue
+		if not isinstance(field, models.ForeignKey):
+			continue
+		path = prefix + name
+		names = [isinstance(item, tuple) and item[0] or item for item in nested]
+		fields = field.rel.to._meta.fields
+		if names and set(names).issubset([f.name for f in fields]) and not covers(path, expanded):
+			paths.extend([path + '__' + f.name for f in fields
+				if not f.name in names and not f.primary_key and not covers(path + '__' + f.name, related)])
+		paths.extend(deferred_paths(field.rel.to, nested, related, expanded, path + '__'))
+	return paths
+
+AGGREGATES = dict(
+	count=models.Count,
+	sum=models.Sum,
+	avg=models.Avg,
+	min=models.Min,
+	max=models.Max,
+)
+"""
+The aggregate functions that can be requested, see
+:attr:`ModelHandler.aggregate`.
+"""
+
+def memoize(method):
+	"""
+	Makes handler method *method* remember its result per request and
+	arguments, so that the data it returns is evaluated only once per
+	request. Is applied by :class:`BaseHandlerMeta` to every definition of
+	:meth:`~BaseHandler.working_set`, :meth:`~BaseHandler.data_set` and
+	:meth:`~BaseHandler.data_item`. Overrides that call their super method
+	work out fine, as the outermost call is the last one to store its
+	result.
+	"""
+	name = method.__name__
+	
+	@wraps(method)
+	def wrapper(self, request, *args, **kwargs):
+		memo = request.__dict__.setdefault('data_memo', {})
+		key = self, name, args, tuple(sorted(kwargs.items()))
+		try:
+			if key in memo:
+				return memo[key]
+		except TypeError:
+			# Unhashable arguments.
+			return method(self, request, *args, **kwargs)
+		memo[key] = method(self, request, *args, **kwargs)
+		return memo[key]
+	
+	wrapper.memoized = True
+	return wrapper
+
+def count_within(data, timeout=None):
+	"""
+	Returns the count of query set *data*, having the database give up on it
+	after *timeout* seconds if it supports that (see
+	:class:`.budget.QueryBudget`).
+	"""
+	with QueryBudget(statement_timeout=timeout):
+		return data.count()
+
+def forget_data(request):
+	"""
+	Discards everything that has been memoized for *request* (see
+	:func:`memoize`), which should be done once data has been written.
+	"""
+	request.__dict__.pop('data_memo', None)
+
+
 class BaseHandlerMeta(handler.HandlerMetaClass):
 	"""
 	Allows a handler class definition to be different from a handler class
@@ -45,6 +205,10 @@ class BaseHandlerMeta(handler.HandlerMetaClass):
 			if attrs.get(operation) is True:
 				del attrs[operation]
 		
+		for name in ('working_set', 'data_set', 'data_item'):
+			if callable(attrs.get(name)) and not getattr(attrs[name], 'memoized', False):
+				attrs[name] = memoize(attrs[name])
+		
 		# Skip the implementation of `handler.HandlerMetaClass` because it is
 		# nothing but a pain in the ass. (It messes up the typemapper and
 		# requires `PISTON_IGNORE_DUPE_MODELS = True`.)
@@ -52,6 +216,27 @@ class BaseHandlerMeta(handler.HandlerMetaClass):
 		
 		if getattr(cls, 'model', None):
 			handler.typemapper[cls] = (cls.model, cls.is_anonymous)
+			
+			if getattr(cls, 'cacheable', False):
+				object_cache.register(cls.model)
+			
+			if getattr(cls, 'fragment_cache', False) and not cls.fragment_version:
+				object_cache.track(cls.model)
+			
+			if getattr(cls, 'advise_indexes', False) is True:
+				cls.advise_indexes = 0.01
+			
+			if getattr(cls, 'since', False) is True:
+				cls.since = 'since'
+			
+			if getattr(cls, 'aggregate', False) is True:
+				cls.aggregate = 'aggregate'
+			
+			if getattr(cls, 'group', False) is True:
+				cls.group = 'group'
+			
+			if getattr(cls, 'since', False):
+				Tombstone.track(cls.model)
 		
 		# At this point, the  enabled operations are:
 		# 		- those that have been enabled as <operation> = True. These keep 	
@@ -78,16 +263,43 @@ class BaseHandlerMeta(handler.HandlerMetaClass):
 		if cls.slice is True:
 			cls.slice = 'slice'
 		
+		if cls.expand is True:
+			cls.expand = 'expand'
+		
+		if cls.export is True:
+			cls.export = 'export'
+		
+		if cls.profile_memory and not profiling.available():
+			raise ImproperlyConfigured("%s.profile_memory requires tracemalloc or the resource module." % name)
+		
 		# Changing this attribute at run-time won't work, but removing the
 		# attribute for that reason is not a good idea, as that would render
 		# the resulting handler type unsuitable for further inheritance.
 		if cls.authentication is True:
 			cls.authentication = DjangoAuthentication()
 		
-		cls.resource = Resource(cls, authentication=cls.authentication)
+		# Every handler type gets its own resource, but it is not created
+		# until it is first needed.
+		cls.resource = LazyResource()
 		
 		return cls
 
+class LazyResource(object):
+	"""
+	Descriptor that creates a handler type's :class:`.resource.Resource` on
+	first access, so that importing a module full of handlers (as every
+	management command does) is cheap.
+	"""
+	
+	lock = threading.Lock()
+	
+	def __get__(self, instance, owner):
+		if not hasattr(self, 'resource'):
+			with self.lock:
+				if not hasattr(self, 'resource'):
+					self.resource = Resource(owner, authentication=owner.authentication)
+		return self.resource
+
 class BaseHandler(handler.BaseHandler):
 	"""
 	All handlers should (directly or indirectly) inherit from this one. Its
@@ -156,12 +368,27 @@ class BaseHandler(handler.BaseHandler):
 		account the settings for :attr:`.fields` and :attr:`.request_fields`,
 		and the query string in *request*. Returns ``()`` in case no
 		selection has been specified in any way.
+		
+		A field in the query string may be a dotted path, as in
+		``?field=mailing.subject``, to select the fields of nested data. See
+		:meth:`.select_nested_fields` for how such a selection ends up in the
+		result.
 		"""
 		
 		# Gets the fields selection as specified in the query string if
 		# enabled and provided, and an empty list in all other scenarios.
 		requested = request.GET.getlist(self.request_fields)
 		
+		# Nested selections are set aside, so that the top-level fields can
+		# be selected as usual.
+		nested = SortedDict()
+		for path in requested:
+			name, _, rest = path.partition('.')
+			nested.setdefault(name, [])
+			if rest:
+				nested[name].append(rest)
+		requested = nested.keys()
+		
 		if self.fields:
 			if requested:
 				requested = set(requested).intersection(self.fields)
@@ -173,7 +400,18 @@ class BaseHandler(handler.BaseHandler):
 			# *self.is_field_allowed* decide if a field should be included.
 			requested = [field for field in requested if self.may_output_field(field)]
 		
-		return tuple(requested)
+		return tuple([nested.get(field) and self.select_nested_fields(field, fields_tree(nested[field])) or field
+			for field in requested])
+	
+	def select_nested_fields(self, field, selection):
+		"""
+		Returns the nested fields selection *selection* for the field named
+		*field*, in Piston's notation: a tuple of *field* and the (cleansed)
+		selection. Non-model data is trusted to contain nothing that should
+		not be exposed, so the default implementation returns *selection*
+		as-is.
+		"""
+		return field, selection
 	
 	def may_output_field(self, field):
 		"""
@@ -205,6 +443,39 @@ class BaseHandler(handler.BaseHandler):
 		
 		return not field in self.exclude_in
 	
+	def compile_validator(self):
+		"""
+		Returns a function that takes a single item of incoming data (a
+		dictionary) and returns a cleansed copy of it, or raises a
+		*ValidationError* if it is not acceptable. The default implementation
+		leaves out the fields that are rejected by :meth:`.may_input_field`.
+		Is called only once per handler type; see :meth:`.get_validator`.
+		"""
+		# As :meth:`.may_input_field` only depends on the handler's
+		# definition, its verdicts can be remembered.
+		accepted = {}
+		
+		def clean(item):
+			cleaned = {}
+			for field, value in item.iteritems():
+				if not field in accepted:
+					accepted[field] = self.may_input_field(field)
+				if accepted[field]:
+					cleaned[field] = value
+			return cleaned
+		
+		return clean
+	
+	def get_validator(self):
+		"""
+		Returns the result of :meth:`.compile_validator`, which is compiled on
+		first use and then kept on the handler type.
+		"""
+		cls = type(self)
+		if not '_validator' in cls.__dict__:
+			cls._validator = staticmethod(self.compile_validator())
+		return cls._validator
+	
 	
 	model_fields = 'model_key', 'model_type', 'model_description'
 	"""
@@ -235,6 +506,45 @@ class BaseHandler(handler.BaseHandler):
 		"""
 		return unicode(instance)
 	
+	share_related = False
+	"""
+	Determines if related model data is shared within a request. If enabled,
+	the records that are referred to by foreign keys in the response are
+	fetched in one query per relation (instead of one query per instance),
+	every record is represented by a single model instance no matter how
+	many instances refer to it, and is constructed only once. See
+	:mod:`.identity`. Disabled (``False``) by default.
+	"""
+	
+	expand = False
+	"""
+	Enables on-demand expansion of related model data. If enabled, a model
+	instance that is referred to by a foreign key is represented by nothing
+	but its key, which is read from the foreign key column so that it takes
+	no query (note that this is the primary key value even if the related
+	handler's :meth:`.model_key` says otherwise). Should be the name of the
+	query string parameter that lists the relations that are to be expanded
+	into a full (nested) representation, or ``True`` if the default
+	(``expand``) should be used. Disabled (``False``) by default.
+	
+	Relations are separated by commas, or given as separate values, and
+	relations of nested data are expanded by their dotted path:
+	``?expand=mailing,mailing.sender`` is the same as
+	``?expand=mailing&expand=mailing.sender``. Expanded relations are
+	fetched in bulk along with the data set.
+	"""
+	
+	def get_expanded_fields(self, request):
+		"""
+		Returns the relations that are to be expanded for this specific
+		request, in Piston's nested fields notation (see :func:`fields_tree`).
+		"""
+		if not self.expand:
+			return ()
+		return fields_tree([relation.strip()
+			for value in request.GET.getlist(self.expand)
+			for relation in value.split(',') if relation.strip()])
+	
 	
 	authentication = None
 	"""
@@ -246,11 +556,102 @@ class BaseHandler(handler.BaseHandler):
 	"""
 	
 	
+	max_concurrency = None
+	"""
+	The maximum number of requests on this handler that a process will
+	handle at the same time, or ``None`` for no limit. Requests beyond this
+	limit wait in line (see :attr:`.max_queue`), and are turned away with a
+	``503 Service Unavailable`` response if the line is full or if their turn
+	does not come within :attr:`.queue_timeout` seconds. Meant for expensive
+	handlers that would otherwise occupy every worker and database connection
+	under load. See :mod:`.admission`.
+	"""
+	
+	max_queue = 0
+	"""
+	The maximum number of requests that wait in line for a turn if
+	:attr:`.max_concurrency` has been reached.
+	"""
+	
+	queue_timeout = 5
+	"""
+	The number of seconds a request waits in line before it is turned away.
+	"""
+	
+	retry_after = 5
+	"""
+	The number of seconds clients are told to wait before they retry a
+	request that was turned away (in the ``Retry-After`` header).
+	"""
+	
+	max_queries = None
+	"""
+	The maximum number of database queries a single request on this handler
+	may make, or ``None`` for no limit. A request that exceeds its budget is
+	aborted with a ``503 Service Unavailable`` response. See :mod:`.budget`.
+	"""
+	
+	max_query_time = None
+	"""
+	The maximum number of seconds a single request on this handler may spend
+	on database queries in total, or ``None`` for no limit. Note that this is
+	checked after every query, so it cannot stop a single query that runs
+	away; see :attr:`.statement_timeout` for that.
+	"""
+	
+	statement_timeout = None
+	"""
+	The maximum number of seconds any single database query of a request on
+	this handler may take, or ``None`` for no limit. Is enforced by the
+	database, if it supports this (PostgreSQL and MySQL 5.7.8 and up).
+	"""
+	
+	profile_memory = False
+	"""
+	The fraction of requests (a number between ``0`` and ``1``, or ``True``
+	for all of them) whose memory usage is profiled by phase. The profile
+	is added to the debug information in the response and sent with the
+	:data:`.signals.memory_profiled` signal. See :mod:`.profiling` for what
+	is measured, which depends on the availability of :mod:`tracemalloc`.
+	"""
+	
+	export = False
+	"""
+	Export query string parameter, or ``True`` if the default (``export``)
+	should be used. A ``GET`` request with this parameter is answered with
+	``202 Accepted`` right away, while its response is produced in the
+	background and kept on disk for download. This is meant for big
+	downloads (think ``?format=excel``) that would otherwise run into
+	timeouts. Disabled (``False``) by default. See :mod:`.export`.
+	"""
+	
+	coalesce = False
+	"""
+	Enables coalescing of concurrent identical ``GET`` requests: while a
+	request is being processed, identical requests (same URL, query string,
+	format, language and authenticated user) wait for its response instead
+	of doing the same work all over. Only use this on handlers whose responses depend on nothing
+	else. Disabled (``False``) by default. See
+	:meth:`.resource.Resource.coalesce`.
+	"""
+	
+	coalesce_timeout = 10
+	"""
+	The number of seconds a coalesced request waits for the response of the
+	request it is coalesced with, before it gives up and computes a response
+	of its own.
+	"""
+	
+	
 	def validate(self, request, *args, **kwargs):
 		"""
-		Validates and cleanses incoming data (in the request body). Can be
-		overridden to extend this behavior with other types of request
-		validation.
+		Validates and cleanses incoming data (in the request body), using the
+		validator returned by :meth:`.get_validator`. Can be overridden to
+		extend this behavior with other types of request validation.
+		
+		Items of an array in the request body that do not validate are left
+		out, and listed in the response under ``invalid`` by their index,
+		along with their errors.
 		"""
 		
 		# TODO: Will *request.data* always be ``None`` if no data was provided
@@ -270,21 +671,29 @@ class BaseHandler(handler.BaseHandler):
 		elif isinstance(request.data, list) and request.method.upper() == 'PUT':
 			raise ValidationError("Illegal operation: PUT request with array in request body")			
 		
-		# Should only happen in POST request with an array of data
+		# Is validated as it comes in, by the handler's *create*.
+		elif isinstance(request.data, Ingest):
+			return
+		
+		# Should only happen in POST request with an array of data. Invalid
+		# items do not fail the entire request, but are left out and reported
+		# in the response (see :meth:`.request`).
 		elif isinstance(request.data, list):
-			new_request_data = []
-			for item in request.data:
-				new_request_data.append(dict([(field, value)
-					for field, value in item.iteritems()
-					if self.may_input_field(field)])							
-				)
-			request.data = new_request_data
+			clean = self.get_validator()
+			valid = []
+			request.invalid = []
+			for index, item in enumerate(request.data):
+				try:
+					if not isinstance(item, dict):
+						raise ValidationError("Data item is not an object.")
+					valid.append(clean(item))
+				except ValidationError, e:
+					request.invalid.append(dict(index=index, errors=e.messages))
+			request.data = valid
 		
 		# Only one data item in request.data
 		else:
-			request.data = dict([(field, value)
-				for field, value in request.data.iteritems()
-				if self.may_input_field(field)])
+			request.data = self.get_validator()(request.data)
 
 	
 	def working_set(self, request, *args, **kwargs):
@@ -425,7 +834,9 @@ class BaseHandler(handler.BaseHandler):
 		# Allow this to be preempted by other methods, which may be useful (or
 		# necessary) in case of big lazy loading data sets.
 		if not 'total' in response:
-			response['total'] = len(data)
+			total = self.count_data(data)
+			if total is not None:
+				response['total'] = total
 		
 		slice = slice.split(':')
 		
@@ -448,15 +859,39 @@ class BaseHandler(handler.BaseHandler):
 		)
 		return True
 	
+	def count_data(self, data):
+		"""
+		Returns the number of items in *data* for the ``total`` of a sliced
+		response, or ``None`` to leave it out. The default implementation
+		relies on ``len()``, so lazy iterables without a length (such as
+		generators) are never consumed just to count them. Can be overridden
+		for data that can be counted by cheaper means.
+		"""
+		try:
+			return len(data)
+		except TypeError:
+			return None
+	
 	def slice_data(self, data, start=None, stop=None, step=None):
 		"""
 		Slices the provided data according to *start*, *stop* and *step*.
+		Iterators, which do not support slicing, are consumed only as far as
+		needed. Any other data that does not support slicing (such as a
+		dictionary) is returned as is.
 		"""
 		try:
 			return data[start:stop:step]
 		except:
 			# Allows us to run *response_slice_data* without having to worry
 			# about if the data is actually sliceable.
+			if not isinstance(data, collections.Iterator):
+				return data
+		
+		try:
+			return list(itertools.islice(data, start, stop, step))
+		except ValueError:
+			# A negative slice argument, which would require consuming the
+			# data in full.
 			return data
 	
 	
@@ -473,15 +908,31 @@ class BaseHandler(handler.BaseHandler):
 		# Pick action to run
 		action = getattr(self, 	resource.Resource.callmap.get(request.method.upper()))
 		# Run
-		response = action(request, *args, **kwargs)
+		with profiling.phase(request, 'data'):
+			response = action(request, *args, **kwargs)
+		
+		# Data that was evaluated before a write may no longer be accurate.
+		if request.method.upper() != 'GET':
+			forget_data(request)
 		# Set response data structure
 		response_structure = self.set_response_data(request,response)
+		
+		# Tells the client which items of an array in the request body were
+		# rejected, by their position in the array.
+		if getattr(request, 'invalid', None):
+			response_structure['invalid'] = request.invalid
 
 		# Slicing should be done after everything else, as it is to be
 		# perceived as a "view on the data set in the response," rather than
 		# a selection mechanism to influence the data that the requested
 		# operation should work with.
 		self.response_slice_data(response_structure, request, *args, **kwargs)
+		
+		# The emitter does not know how to deal with iterators, so the ones
+		# that are left are materialized.
+		data = self.get_response_data(request, response_structure)
+		if isinstance(data, collections.Iterator):
+			self.set_response_data(request, list(data), response_structure)
 
 		self.enrich_response(request, response, response_structure)
 		
@@ -534,6 +985,10 @@ class BaseHandler(handler.BaseHandler):
 			query_log=connection.queries,
 			query_count=len(connection.queries),
 		)
+		# The profile is still being filled in, but it will be complete (save
+		# for the render phase) by the time it is serialized.
+		if getattr(request, 'memory_profile', None):
+			response['debug']['memory'] = request.memory_profile.phases
 		return response
 	
 	def response_constructed(self, response, unconstructed, request):
@@ -547,6 +1002,7 @@ class BaseHandler(handler.BaseHandler):
 		
 		if request.method.upper() == 'DELETE':
 			self.data_safe_for_delete(self.get_response_data(request, unconstructed))
+			forget_data(request)
 		
 		if settings.DEBUG:
 			response = self.response_add_debug(response, request)
@@ -585,6 +1041,97 @@ class ModelHandler(BaseHandler):
 	another model object.
 	"""
 	
+	cacheable = False
+	"""
+	Declares :attr:`.model` to be cacheable across requests. If ``True``,
+	instances of the model that are loaded as related data by handlers that
+	have :attr:`~BaseHandler.share_related` enabled are kept in a
+	process-wide cache, and are invalidated whenever an instance of the model
+	is saved or deleted. Meant for small models that are nested in many
+	responses. See :mod:`.cache` for the settings that apply.
+	"""
+	
+	fragment_cache = False
+	"""
+	Enables caching of the constructed representation of every instance in
+	the response to ``GET`` requests, so that a list response is assembled
+	from cached representations and only the instances that are not in cache
+	are constructed. A representation is cached per handler, instance,
+	version (see :attr:`.fragment_version`) and effective fields selection.
+	See :mod:`.cache` for the settings that apply.
+	
+	Note that a cached representation includes nested data, which is not
+	refreshed until the instance's own version changes or the representation
+	expires.
+	"""
+	
+	fragment_version = None
+	"""
+	The name of a field on :attr:`.model` whose value changes whenever an
+	instance changes, such as a modification timestamp or a revision
+	counter. If ``None``, every save or delete of any instance of the model
+	invalidates all of its cached representations. In that case, unless
+	``PISTON_OBJECT_CACHE_SHARED = True``, representations are cached per
+	process, and other processes only notice a change once their copies
+	expire.
+	"""
+	
+	def get_fragment_versions(self, instances):
+		"""
+		Returns the versions of *instances* that their cached representations
+		should be keyed on, in the same order. See :attr:`.fragment_version`.
+		"""
+		if self.fragment_version:
+			return [getattr(instance, self.fragment_version) for instance in instances]
+		# The version of the model, which is looked up only once as it may
+		# take a round-trip to the shared cache.
+		return [object_cache.version(self.model)] * len(instances)
+	
+	def has_local_fragments(self):
+		"""
+		Returns whether cached representations are keyed on a version that
+		is local to the process, and should therefore be kept in the process.
+		"""
+		return not self.fragment_version and not object_cache.shared()
+	
+	@classmethod
+	def get_nested_fields(cls):
+		"""
+		Returns the fields that are allowed in a nested representation of this
+		handler's model, which is :attr:`~BaseHandler.fields` minus
+		:attr:`.exclude_nested`, or ``()`` if there is no such
+		specification.
+		"""
+		return tuple(set(cls.fields) - set(cls.exclude_nested))
+	
+	def select_nested_fields(self, field, selection):
+		"""
+		Cleanses *selection* against the fields that are allowed in the nested
+		representation of the model that *field* refers to, at every depth.
+		If *field* is not a relation, the nested selection is ignored.
+		"""
+		
+		def select(model, selection):
+			mapped = handler_for_model(model)
+			allowed = mapped and mapped.get_nested_fields() or self.model_fields
+			
+			selected = []
+			for field in selection:
+				if isinstance(field, tuple):
+					name, nested = field
+					if name in allowed:
+						related = related_model(model, name)
+						nested = related and select(related, nested)
+						selected.append(nested and (name, nested) or name)
+				elif field in allowed:
+					selected.append(field)
+			return tuple(selected)
+		
+		related = related_model(self.model, field)
+		selection = related and select(related, selection)
+		
+		return selection and (field, selection) or field
+	
 	
 	def may_input_field(self, field):
 		result = super(ModelHandler, self).may_input_field(field)
@@ -598,7 +1145,50 @@ class ModelHandler(BaseHandler):
 			return not self.model._meta.get_field(field, many_to_many=False).primary_key
 		except models.FieldDoesNotExist:
 			return False
-			
+	
+	def compile_validator(self):
+		"""
+		Extends the default validator by converting the values of model
+		fields to their Python types (as defined by the model field) and
+		rejecting ``null`` values for fields that cannot be empty. Foreign keys
+		are accepted by their primary key value.
+		"""
+		accept = super(ModelHandler, self).compile_validator()
+		
+		fields = {}
+		for field in self.model._meta.fields:
+			if not self.may_input_field(field.name):
+				continue
+			if isinstance(field, models.ForeignKey):
+				fields[field.name] = field.attname, field.null, field.rel.get_related_field().to_python
+			else:
+				fields[field.name] = field.name, field.null, field.to_python
+		
+		def clean(item):
+			cleaned = {}
+			errors = []
+			for field, value in accept(item).iteritems():
+				if not field in fields:
+					# Accepted by an extended *may_input_field*, so it is up
+					# to the extension to deal with it.
+					cleaned[field] = value
+					continue
+				name, null, to_python = fields[field]
+				if value is None:
+					if not null:
+						errors.append(u"%s: This field cannot be null." % field)
+						continue
+					cleaned[name] = None
+					continue
+				try:
+					cleaned[name] = to_python(value)
+				except ValidationError, e:
+					errors.extend([u"%s: %s" % (field, message) for message in e.messages])
+			if errors:
+				raise ValidationError(errors)
+			return cleaned
+		
+		return clean
 	
 	def validate(self, request, *args, **kwargs):
 		"""
@@ -612,7 +1202,8 @@ class ModelHandler(BaseHandler):
 		# TODO: Will *request.data* always be ``None`` if no data was provided
 		# in the request body? Will Piston even allow for an empty request
 		# body?
-		if request.data is None:
+		# Data that is read incrementally is validated as it comes in.
+		if request.data is None or isinstance(request.data, Ingest):
 			return
 
 		if request.method.upper() == 'POST':
@@ -678,29 +1269,217 @@ class ModelHandler(BaseHandler):
 		
 		# Update 5/1/2012: Using ``depth=1`` forces the select_related to go up
 		# to a depth of 1 to retrieve foreign keys.
+		
+		# Related records that end up in the response can be shared between
+		# instances by means of an identity map; see *share_related*.
 
 		return self.model.objects.filter(**kwargs)
 	
+	def data_set(self, request, *args, **kwargs):
+		data = super(ModelHandler, self).data_set(request, *args, **kwargs)
+		
+		# A nested fields selection tells us exactly which related records
+		# (and which of their fields) are going to be needed, so we can fetch
+		# them along with the data set instead of one at a time while
+		# constructing the response. Expanded relations are needed in full.
+		requested = self.get_requested_fields(request)
+		expanded = forward_paths(self.model, self.get_expanded_fields(request), leaves=True)
+		related = forward_paths(self.model, requested) + expanded
+		if related and isinstance(data, models.query.QuerySet):
+			data = data.select_related(*related)
+			deferred = deferred_paths(self.model, requested, related, expanded)
+			if deferred:
+				data = data.defer(*deferred)
+		
+		# In delta mode, changes are returned in the order in which they
+		# happened, so that a slice of them yields a sensible cursor.
+		cursor = self.get_cursor(request)
+		if cursor is not None and isinstance(data, models.query.QuerySet):
+			tombstone, value, pk = cursor
+			if tombstone is None:
+				# This has to be read before the data is, or a deletion in
+				# between would never be reported.
+				self.get_last_tombstone(request)
+			if value is not None and pk is not None:
+				data = data.filter(
+					models.Q(**{ '%s__gt' % self.since_field: value }) |
+					models.Q(**{ self.since_field: value, 'pk__gt': pk })
+				)
+			elif value is not None:
+				data = data.filter(**{ '%s__gte' % self.since_field: value })
+			data = data.order_by(self.since_field, 'pk')
+		
+		data = self.read_from(request, data)
+		
+		if self.advise_indexes and isinstance(data, models.query.QuerySet) and \
+			random.random() < self.advise_indexes:
+			advisor.record(type(self),
+				[definition for name, definition in (self.filters or {}).iteritems() if request.GET.getlist(name)],
+				request.GET.getlist(self.order),
+				self.slice and request.GET.get(self.slice),
+				data,
+			)
+		
+		return data
+	
+	advise_indexes = False
+	"""
+	The fraction of requests (a number between ``0`` and ``1``) whose
+	combination of filters and ordering is sampled for index advice, or
+	``True`` to sample one in a hundred. See :mod:`.advisor`.
+	"""
+	
+	since = False
+	"""
+	Delta sync query string parameter, or ``True`` if the default (``since``)
+	should be used. A ``GET`` request on the data set with this parameter
+	gets a ``cursor`` in its response. Passing that cursor as the value of
+	the parameter on the next request yields only the items that were
+	created or updated since (filters and fields selection apply as usual),
+	along with the primary keys of the items that were ``deleted`` since.
+	An empty value yields all items, and a cursor to start from.
+	
+	Changes are returned in order of :attr:`.since_field` and primary key,
+	and the cursor denotes the last item returned, so a sliced request picks
+	up exactly where the previous one left off, even if many items changed
+	at the same moment. Deletions are not subject to filters or the working
+	set, so a client may be told about deletions of items it never had, or
+	of items that it gets in the same response.
+	
+	Requires :attr:`.since_field`, and :mod:`piston_perfect` in
+	``INSTALLED_APPS`` (for :class:`.models.Tombstone`). Disabled
+	(``False``) by default.
+	"""
+	
+	since_field = None
+	"""
+	The name of the field that tells when an item was last changed, for use
+	with :attr:`.since`: a timestamp that is set on every save (think
+	``auto_now=True``) or an ever increasing sequence number. Should be
+	indexed.
+	"""
+	
+	def get_cursor(self, request):
+		"""
+		Returns the delta sync cursor of *request* as a tuple of the last
+		tombstone that the client knows of (or ``None`` if it knows nothing),
+		and the value of :attr:`.since_field` and the primary key of the last
+		item that it has seen changes up to (both ``None`` if it has seen
+		none). Returns ``None`` if the request is not for changes.
+		"""
+		if not self.since or request.method.upper() != 'GET' or not self.since in request.GET:
+			return None
+		
+		cursor = request.GET.get(self.since)
+		if not cursor:
+			return None, None, None
+		
+		# The value may contain colons itself (think times), the others not.
+		tombstone, _, rest = cursor.partition(':')
+		value, _, pk = rest.rpartition(':')
+		try:
+			tombstone = int(tombstone)
+			# A value or primary key may well be 0, which is not the same as
+			# having none.
+			if value != '':
+				value = self.model._meta.get_field(self.since_field).to_python(value)
+			else:
+				value = None
+			if pk != '':
+				pk = self.model._meta.pk.to_python(pk)
+			else:
+				pk = None
+		except (ValueError, ValidationError):
+			raise ValidationError("Invalid cursor.")
+		return tombstone, value, pk
+	
+	def get_tombstones(self, request):
+		"""
+		Returns the tombstones of :attr:`.model`, read from the same database
+		as the data, so the two are consistent.
+		"""
+		return self.read_from(request, Tombstone.objects.filter(model=model_label(self.model)))
+	
+	def get_last_tombstone(self, request):
+		"""
+		Returns the id of the last tombstone of :attr:`.model` as of the first
+		call for *request* (or ``0`` if there is none), which is where a
+		client that starts from scratch picks up deletions.
+		"""
+		if not hasattr(request, 'last_tombstone'):
+			request.last_tombstone = self.get_tombstones(request) \
+				.aggregate(last=models.Max('id'))['last'] or 0
+		return request.last_tombstone
+	
+	def response_add_changes(self, response, request, cursor):
+		"""
+		Adds the deletions and the next cursor to a delta sync response.
+		"""
+		tombstone, value, pk = cursor
+		
+		# Evaluating the data here fills its result cache, so the emitter
+		# does not have to evaluate it again.
+		data = list(self.get_response_data(request, response))
+		if data:
+			value = getattr(data[-1], self.since_field)
+			pk = data[-1].pk
+		
+		response['deleted'] = []
+		if tombstone is None:
+			# A client that starts from scratch has nothing to delete.
+			tombstone = self.get_last_tombstone(request)
+		else:
+			tombstones = self.get_tombstones(request)
+			for tombstone, object_id in tombstones.filter(id__gt=tombstone).order_by('id').values_list('id', 'object_id'):
+				response['deleted'].append(self.model._meta.pk.to_python(object_id))
+		
+		response['cursor'] = u'%d:%s:%s' % (tombstone,
+			value is not None and unicode(value) or u'',
+			pk is not None and unicode(pk) or u'',
+		)
+		return response
+	
 	def data_item(self, request, *args, **kwargs):
 		# First we check if we have been provided with conditions that are
 		# capable of denoting a single item. If we would try to ``get`` an
 		# instance based on *kwargs* right away, things would go wrong in case
 		# of a set with one element. This element would be returned by this
 		# method as if it was explicitly requested.
+		unique = self.get_unique_fields()
 		for field in kwargs.keys():
-			try:
-				if self.model._meta.get_field(field).unique:
-					# We found a parameter that identifies a single item, so
-					# we assume that singular data was requested. If the data
-					# turns out not to be there, the raised exception will
-					# automatically be handled by the error handler in
-					# Resource.
-					return self.working_set(request, *args, **kwargs).get(**{ field: kwargs.get(field) })
-			except models.FieldDoesNotExist:
-				# No field named *field* on *self.model*, try next field.
-				pass
+			if field in unique:
+				# We found a parameter that identifies a single item, so
+				# we assume that singular data was requested. If the data
+				# turns out not to be there, the raised exception will
+				# automatically be handled by the error handler in
+				# Resource.
+				return self.read_from(request, self.working_set(request, *args, **kwargs)).get(**{ field: kwargs.get(field) })
 		return super(ModelHandler, self).data_item(request, *args, **kwargs)
 	
+	def read_from(self, request, data):
+		"""
+		Has the *QuerySet* *data* read from the database that is picked for
+		*request* by :func:`.routing.read_database`, which is a replica for
+		most ``GET`` requests. Any count for slicing follows suit.
+		"""
+		if not hasattr(request, 'read_database'):
+			request.read_database = routing.read_database(request)
+		if request.read_database and isinstance(data, models.query.QuerySet):
+			return data.using(request.read_database)
+		return data
+	
+	@classmethod
+	def get_unique_fields(cls):
+		"""
+		Returns the names of the fields that identify a single instance of
+		:attr:`.model`. Is determined once per handler type.
+		"""
+		if not '_unique_fields' in cls.__dict__:
+			cls._unique_fields = frozenset([field.name
+				for field in cls.model._meta.fields + cls.model._meta.many_to_many
+				if field.unique])
+		return cls._unique_fields
+	
 	def filter_data(self, data, definition, values):
 		"""
 		Recognizes and applies two types of filters:
@@ -741,39 +1520,240 @@ class ModelHandler(BaseHandler):
 	def order_data(self, data, *order):
 		return data.order_by(*order)
 	
+	concurrent_count = False
+	"""
+	If ``True``, the ``total`` count of a sliced ``GET`` response is obtained
+	in a separate thread (and thus on a separate database connection) while
+	the request thread fetches the page itself, which roughly halves the
+	latency of sliced responses if both queries are of similar cost. May also
+	be defined as a number, which is then interpreted as the maximum number of
+	seconds to wait for the count to come in (where the database supports
+	statement timeouts, the count is also stopped after that time, so that
+	it does not hold on to its thread and connection). The threads are taken
+	from a process-wide pool of ``PISTON_COUNT_THREADS`` (default ``4``)
+	threads.
+	
+	Note that the count does not see any uncommitted changes in the request's
+	transaction, which is why this only applies to ``GET`` requests.
+	"""
+	
+	estimate_count = False
+	"""
+	If ``True``, a count of the ``total`` number of items in a sliced
+	response that exceeds the request's query budget (see
+	:attr:`~BaseHandler.max_queries`, :attr:`~BaseHandler.max_query_time` and
+	:attr:`~BaseHandler.statement_timeout`) does not fail the request, but is
+	replaced by the query planner's estimate if the database offers one, and
+	left out otherwise. The response then says ``total_estimated: true``.
+	"""
+	
+	def count_queryset(self, data):
+		"""
+		Returns the number of items in the *QuerySet* *data*, or an estimate
+		(see :attr:`.estimate_count`), and whether it is an estimate.
+		"""
+		budget = current_budget()
+		if not self.estimate_count or budget is None:
+			return data.count(), False
+		
+		# Savepoints are bookkeeping, and should work regardless of the budget
+		# (or rather: especially if it is exceeded).
+		with budget.exemption(charge=False):
+			sid = transaction.savepoint(using=data.db)
+		try:
+			count = data.count()
+		except QueryBudgetExceeded:
+			# Getting past a database-side timeout requires a rollback.
+			with budget.exemption(charge=False):
+				transaction.savepoint_rollback(sid, using=data.db)
+			with budget.exemption():
+				return self.estimate_data_count(data), True
+		with budget.exemption(charge=False):
+			transaction.savepoint_commit(sid, using=data.db)
+		return count, False
+	
+	def estimate_data_count(self, data):
+		"""
+		Returns the query planner's estimate of the number of items in the
+		*QuerySet* *data*, or ``None`` if the database does not offer one.
+		"""
+		db = connections[data.db]
+		sql, params = data.query.get_compiler(data.db).as_sql()
+		
+		if db.vendor == 'postgresql':
+			cursor = db.cursor()
+			cursor.execute('EXPLAIN ' + sql, params)
+			match = re.search(r'rows=(\d+)', cursor.fetchone()[0])
+			return match and int(match.group(1))
+		
+		if db.vendor == 'mysql':
+			cursor = db.cursor()
+			cursor.execute('EXPLAIN ' + sql, params)
+			columns = [column[0] for column in cursor.description]
+			return int(cursor.fetchone()[columns.index('rows')])
+		
+		return None
+	
 	def response_slice_data(self, response, request, *args, **kwargs):
 		data = self.get_response_data(request, response)
 		
+		count = None
+		
+		timeout = self.concurrent_count
+		if timeout is True:
+			timeout = None
+		
 		# Optimization for lazy and potentially large query sets.
-		if isinstance(data, models.query.QuerySet) and self.slice in request.GET:
-			response['total'] = data.count()
+		if isinstance(data, models.query.QuerySet) and request.GET.get(self.slice):
+			if self.concurrent_count and request.method.upper() == 'GET':
+				count = get_pool('count', getattr(settings, 'PISTON_COUNT_THREADS', 4)).apply_async(
+					in_thread(count_within), (data, timeout))
+				# Prevents the base implementation from counting on its own.
+				response['total'] = None
+			else:
+				# Note that an estimate can be ``None``, which still prevents
+				# the base implementation from counting on its own.
+				response['total'], estimated = self.count_queryset(data)
+				if estimated:
+					response['total_estimated'] = True
 		
 		sliced = super(ModelHandler, self).response_slice_data(response, request, *args, **kwargs)
 		
+		if count:
+			try:
+				# Evaluate the page while the count is running, instead of
+				# leaving it to the emitter.
+				if sliced:
+					len(self.get_response_data(request, response))
+			except Exception:
+				# Also wait for the count if the page query failed, so that
+				# we don't return while it still occupies a connection, but
+				# don't let the count hide what went wrong with the page.
+				exc_info = sys.exc_info()
+				try:
+					count.get(timeout)
+				except Exception:
+					pass
+				raise exc_info[0], exc_info[1], exc_info[2]
+			# An error or timeout in the count itself is raised here.
+			response['total'] = count.get(timeout)
+		
 		if not sliced and 'total' in response:
 			del response['total']
+			response.pop('total_estimated', None)
 		
 		return sliced
 	
 	
+	def request(self, request, *args, **kwargs):
+		response = super(ModelHandler, self).request(request, *args, **kwargs)
+		
+		cursor = self.get_cursor(request)
+		if cursor is not None and self.get_aggregates(request) is None and \
+			self.data_item(request, *args, **kwargs) is None:
+			self.response_add_changes(response, request, cursor)
+		
+		return response
+	
+	ingest = False
+	"""
+	If ``True``, the body of a ``POST`` request that holds a JSON array
+	(content type ``application/json``) or newline-delimited JSON
+	(``application/x-ndjson``) is not parsed in full, but read, validated and
+	inserted in batches of :attr:`.ingest_batch_size` items as it comes in.
+	Instead of the created data, the response contains a summary: the number
+	of items that were ``created`` and that ``failed``, with the failed items
+	listed under ``invalid`` (see :meth:`~BaseHandler.validate`). A body that
+	cannot be read any further (say, a syntax error halfway) ends the
+	ingestion with an entry in ``invalid`` at the index where reading
+	stopped, but the items before that are created all the same. Other JSON
+	bodies (such as a single object) are parsed and created as usual.
+	"""
+	
+	ingest_batch_size = 500
+	"""
+	The number of items that are inserted in one transaction in
+	:attr:`.ingest` mode.
+	"""
+	
+	def ingest_data(self, request, items):
+		"""
+		Validates and inserts the ``(index, item)`` tuples from *items* in
+		batches. Returns the number of created records, and adds the failed
+		items to ``request.invalid``. A body that turns out to be invalid
+		halfway is added as well, with the index of the item at which reading
+		stopped, and what was read before that is inserted all the same.
+		"""
+		clean = self.get_validator()
+		request.invalid = []
+		created = 0
+		
+		def read(items):
+			index = -1
+			try:
+				for index, item in items:
+					yield index, item
+			except ValidationError, e:
+				# Earlier batches have been committed, so this has to be
+				# reported along with them.
+				request.invalid.append(dict(index=index + 1, errors=e.messages))
+		
+		batch = []
+		for index, item in itertools.chain(read(items), [(None, None)]):
+			if index is not None:
+				try:
+					if isinstance(item, ValidationError):
+						raise item
+					if not isinstance(item, dict):
+						raise ValidationError("Data item is not an object.")
+					batch.append((index, self.model(**clean(item))))
+				except ValidationError, e:
+					request.invalid.append(dict(index=index, errors=e.messages))
+				if len(batch) < self.ingest_batch_size:
+					continue
+			
+			if not batch:
+				continue
+			
+			try:
+				with transaction.commit_on_success():
+					for index, instance in batch:
+						instance.save(force_insert=True)
+				created += len(batch)
+			except Exception:
+				# Find out which ones are to blame by giving every instance a
+				# transaction of its own. Primary keys that were generated in
+				# the rolled back transaction are void.
+				for index, instance in batch:
+					if isinstance(self.model._meta.pk, models.AutoField):
+						instance.pk = None
+					try:
+						with transaction.commit_on_success():
+							instance.save(force_insert=True)
+						created += 1
+					except Exception, e:
+						request.invalid.append(dict(index=index, errors=[unicode(e)]))
+			batch = []
+		
+		return created
+	
 	def create(self, request, *args, **kwargs):
-		if isinstance(request.data, list):
+		if isinstance(request.data, Ingest):
+			created = self.ingest_data(request, request.data)
+			request.data = dict(created=created, failed=len(request.invalid))
+		
+		elif isinstance(request.data, list):
 			# request.data is an array of self.model instances
 			
-			unsuccessful = []
+			# Leave out the model instances that were not saved successfully.
+			created = []
 			for instance in request.data:
 				try:
 					instance.save(force_insert=True)
 				except:
-					unsuccessful.append(instance)
-
-			if unsuccessful:
-				# Remove model instances that were not saved successfully, from
-				# ``request.data``
-				request.data = set(request.data) - set(unsuccessful)
-			else:
-				# All instances have been saved successfully:
-				pass
+					continue
+				created.append(instance)
+			request.data = created
 
 		else:
 			# request.data is a single self.model instance
@@ -789,7 +1769,91 @@ class ModelHandler(BaseHandler):
 		
 		return super(ModelHandler, self).create(request, *args, **kwargs)
 	
-	read = True
+	def read(self, request, *args, **kwargs):
+		aggregates = self.get_aggregates(request)
+		if aggregates is None or not self.data_item(request, *args, **kwargs) is None:
+			return super(ModelHandler, self).read(request, *args, **kwargs)
+		
+		# Ordering would end up in the grouping, so it has to go.
+		data = self.data_set(request, *args, **kwargs).order_by()
+		
+		groups = self.get_groups(request)
+		if not groups:
+			return data.aggregate(**aggregates)
+		return list(data.values(*groups).annotate(**aggregates).order_by(*groups))
+	
+	aggregate = False
+	"""
+	Aggregation query string parameter, or ``True`` if the default
+	(``aggregate``) should be used. A ``GET`` request on the data set with
+	this parameter does not get the items, but aggregates over them, which
+	are computed by the database. Every value of the parameter is of the
+	form ``<function>:<field>``, in which the function is one of ``count``,
+	``sum``, ``avg``, ``min`` and ``max``, and the field is one of
+	:attr:`.aggregate_fields` (``count`` may go without a field to count the
+	items). The aggregates are named ``<function>_<field>`` (or just
+	``count``) in the response. Filters and the working set apply as usual.
+	Disabled (``False``) by default. See also :attr:`.group`.
+	"""
+	
+	aggregate_fields = ()
+	"""
+	The fields (or lookup paths, as in ``mailing__size``) that may be
+	aggregated over.
+	"""
+	
+	group = False
+	"""
+	Grouping query string parameter, or ``True`` if the default (``group``)
+	should be used. Has the aggregates (see :attr:`.aggregate`) computed per
+	distinct combination of values of the fields that are given by the
+	values of this parameter, which must be among :attr:`.group_fields`. The
+	response then holds a list of groups, each with its values and
+	aggregates. Disabled (``False``) by default.
+	"""
+	
+	group_fields = ()
+	"""
+	The fields (or lookup paths) that aggregates may be grouped by.
+	"""
+	
+	def get_aggregates(self, request):
+		"""
+		Returns the aggregates that *request* asks for, by name, or ``None``
+		if it does not ask for any.
+		"""
+		if not self.aggregate or request.method.upper() != 'GET':
+			return None
+		
+		specs = request.GET.getlist(self.aggregate)
+		if not specs:
+			return None
+		
+		aggregates = SortedDict()
+		for spec in specs:
+			function, _, field = spec.partition(':')
+			if not function in AGGREGATES:
+				raise ValidationError("Unknown aggregate function: %s" % function)
+			if field and not field in self.aggregate_fields:
+				raise ValidationError("Cannot aggregate over field: %s" % field)
+			if not field and function != 'count':
+				raise ValidationError("Aggregate function requires a field: %s" % function)
+			name = field and '%s_%s' % (function, field) or function
+			aggregates[name] = AGGREGATES[function](field or self.model._meta.pk.name)
+		return aggregates
+	
+	def get_groups(self, request):
+		"""
+		Returns the fields that *request* asks to group aggregates by.
+		"""
+		if not self.group:
+			return []
+		
+		groups = request.GET.getlist(self.group)
+		for field in groups:
+			if not field in self.group_fields:
+				raise ValidationError("Cannot group by field: %s" % field)
+		return groups
 	
 	def update(self, request, *args, **kwargs):
 		# Returns the model instance(s) in request.data, that have been
@@ -0,0 +1,106 @@
+"""
+Request-scoped sharing of related model instances. See
+:attr:`.handlers.BaseHandler.share_related`.
+"""
+
+from django.db import router
+from django.db.models.query import QuerySet
+from .cache import object_cache
+
+
+class IdentityMap(object):
+	"""
+	Keeps one instance per model type and primary key, so that every model
+	instance that refers to a certain record refers to the same object, and
+	remembers the constructed (serialized) representation of every instance
+	so that it needs to be constructed only once.
+	"""
+
+	def __init__(self):
+		self.instances = {}
+		self.constructed = {}
+
+	def add(self, model, instance):
+		"""
+		Registers *instance* of type *model*, unless an instance of the same
+		record is known already. Returns the registered instance.
+		"""
+		return self.instances.setdefault((model, instance.pk), instance)
+
+	def fetch(self, model, pks, using=None):
+		"""
+		Returns the instances of *model* with primary keys *pks* in a single
+		query on database *using*. The manager is picked the same way
+		Django's foreign key descriptor does. Instances of cacheable models
+		are taken from the object cache if possible, and only the ones that
+		are not are queried.
+		"""
+		cached = {}
+		if object_cache.is_cacheable(model):
+			cached = object_cache.get_many(model, pks)
+			pks = [pk for pk in pks if not pk in cached]
+			if not pks:
+				return cached.values()
+		
+		manager = model._default_manager
+		if not getattr(manager, 'use_for_related_fields', False):
+			manager = QuerySet(model)
+		fetched = list(manager.using(using).filter(pk__in=pks))
+		
+		if object_cache.is_cacheable(model):
+			object_cache.set_many(model, fetched)
+		
+		return cached.values() + fetched
+
+	def load_related(self, instances, field):
+		"""
+		Points the foreign key *field* of every instance in *instances* to the
+		shared instance of the related record, fetching the records that are
+		not known yet in one go. Instances that had the related record loaded
+		already (by *select_related*) are pointed to the shared instance as
+		well, so that their private copies can be freed. Returns the related
+		instances that were not known before.
+		"""
+		model = field.rel.to
+		cache_name = field.get_cache_name()
+
+		# We can only look records up by primary key.
+		if field.rel.field_name != model._meta.pk.name:
+			return []
+
+		new = []
+		# Related records are read from the database that the foreign key
+		# descriptor would read them from, which is the database that the
+		# instance came from (such as a replica, see :mod:`.routing`) unless
+		# a router says otherwise.
+		missing = {}
+		for instance in instances:
+			value = getattr(instance, field.attname)
+			if value is None:
+				continue
+			if (model, value) in self.instances:
+				continue
+			if hasattr(instance, cache_name):
+				new.append(self.add(model, getattr(instance, cache_name)))
+			else:
+				missing.setdefault(router.db_for_read(model, instance=instance), set()).add(value)
+
+		for using, pks in missing.iteritems():
+			new.extend([self.add(model, related) for related in self.fetch(model, pks, using)])
+
+		for instance in instances:
+			related = self.instances.get((model, getattr(instance, field.attname)))
+			if related is not None:
+				setattr(instance, cache_name, related)
+
+		return new
+
+	def construct(self, model, instance, construct):
+		"""
+		Returns the constructed representation of *instance* of type *model*,
+		calling *construct* with *instance* only the first time around.
+		"""
+		key = model, instance.pk
+		if not key in self.constructed:
+			self.constructed[key] = construct(instance)
+		return self.constructed[key]
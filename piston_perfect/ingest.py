@@ -0,0 +1,188 @@
+"""
+Incremental parsing of large request bodies. See
+:attr:`.handlers.ModelHandler.ingest`.
+"""
+
+import StringIO, codecs
+from django.core.exceptions import ValidationError
+from django.utils import simplejson
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class Ingest(object):
+	"""
+	Takes the place of the parsed data on a request whose body is read as it
+	is being processed. Iterating yields ``(index, item)`` tuples, in which
+	*item* is whatever was decoded at position *index*, or a
+	*ValidationError* if it could not be decoded (which only happens with
+	newline-delimited JSON, as an invalid line does not affect the lines
+	that follow it). A body that cannot be read any further (as it is not
+	valid UTF-8, or not a valid JSON array) raises a *ValidationError*
+	while iterating.
+	"""
+
+	def __init__(self, items):
+		self.items = items
+
+	def __iter__(self):
+		return self.items
+
+	@classmethod
+	def from_request(cls, request):
+		"""
+		Returns an instance that reads the body of *request*, or ``None`` if
+		it is not one that can be read incrementally: if its content type is
+		not one of the above, or if it is JSON but not an array (such as a
+		single object), which is left to Piston to parse as usual.
+		"""
+		content_type = request.META.get('CONTENT_TYPE', '').split(';')[0].strip()
+		if content_type == 'application/x-ndjson':
+			return cls(iter_ndjson(read_chunks(request)))
+		if content_type == 'application/json':
+			head = peek(request)
+			if head.lstrip()[:1] == '[':
+				return cls(iter_json_array(read_chunks(request, head)))
+			unread(request, head)
+		return None
+
+
+def peek(request):
+	"""
+	Reads the body of *request* up to (at least) its first character that is
+	not whitespace, and returns what was read.
+	"""
+	head = ''
+	while not head.strip():
+		chunk = request.read(CHUNK_SIZE)
+		if not chunk:
+			break
+		head += chunk
+	return head
+
+def unread(request, head):
+	"""
+	Makes the body of *request*, of which *head* has been read already,
+	available as if nothing had been read (the way Django itself does once
+	it has read the body in full).
+	"""
+	request._raw_post_data = head + request.read()
+	request._stream = StringIO.StringIO(request._raw_post_data)
+
+def read_chunks(request, head='', size=CHUNK_SIZE):
+	"""
+	Yields the body of *request*, of which *head* has been read already, as
+	unicode strings of (roughly) *size* bytes. Raises a *ValidationError* as
+	soon as the body turns out not to be valid UTF-8.
+	"""
+	decoder = codecs.getincrementaldecoder('utf-8')()
+	try:
+		if head:
+			yield decoder.decode(head)
+		while True:
+			chunk = request.read(size)
+			if not chunk:
+				break
+			yield decoder.decode(chunk)
+		yield decoder.decode('', final=True)
+	except UnicodeDecodeError:
+		raise ValidationError("Data is not valid UTF-8.")
+
+def iter_ndjson(chunks):
+	decoder = simplejson.JSONDecoder()
+	index = 0
+	buffer = u''
+	for chunk in chunks:
+		buffer += chunk
+		lines = buffer.split(u'\n')
+		buffer = lines.pop()
+		for line in lines:
+			if line.strip():
+				yield index, decode_line(decoder, line)
+				index += 1
+	if buffer.strip():
+		yield index, decode_line(decoder, buffer)
+
+def decode_line(decoder, line):
+	try:
+		return decoder.decode(line)
+	except ValueError:
+		return ValidationError("Data item is not valid JSON.")
+
+def iter_json_array(chunks):
+	"""
+	Yields the items of a JSON array, decoding each of them as soon as it has
+	been read in full. Invalid JSON cannot be recovered from, so it raises a
+	*ValidationError*.
+	"""
+	decoder = simplejson.JSONDecoder()
+	chunks = iter(chunks)
+	buffer = u''
+	position = 0
+	exhausted = False
+	# What comes next: the opening bracket, the first item (or the closing
+	# bracket), an item, a separator (or the closing bracket), or nothing but
+	# whitespace.
+	expect = 'start'
+	index = 0
+
+	while True:
+		# Skip whitespace, which requires at least one other character to be
+		# available.
+		while position < len(buffer) and buffer[position].isspace():
+			position += 1
+
+		if expect == 'end':
+			if position < len(buffer):
+				raise ValidationError("Data is not a valid JSON array.")
+			buffer = u''
+			position = 0
+
+		elif position < len(buffer):
+			char = buffer[position]
+
+			if expect == 'start':
+				if char != u'[':
+					raise ValidationError("Data is not an array.")
+				expect = 'first'
+				position += 1
+				continue
+
+			if expect in ('first', 'separator') and char == u']':
+				expect = 'end'
+				position += 1
+				continue
+
+			if expect == 'separator':
+				if char != u',':
+					raise ValidationError("Data is not a valid JSON array.")
+				expect = 'item'
+				position += 1
+				continue
+
+			try:
+				item, end = decoder.raw_decode(buffer, position)
+			except ValueError:
+				end = None
+			# A value that runs up to the end of the buffer may be incomplete
+			# (think of numbers), so we only accept it if there is nothing
+			# left to read.
+			if end is not None and (end < len(buffer) or exhausted):
+				yield index, item
+				index += 1
+				expect = 'separator'
+				# Keeps the buffer from growing with the body.
+				buffer = buffer[end:]
+				position = 0
+				continue
+
+		if exhausted:
+			if expect == 'end':
+				return
+			raise ValidationError("Data is not a valid JSON array.")
+
+		try:
+			buffer += chunks.next()
+		except StopIteration:
+			exhausted = True
@@ -0,0 +1,53 @@
+"""
+Measures what it costs a process to import the API.
+"""
+
+import os, subprocess, sys
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+
+
+# Is run in a fresh interpreter for every measurement, as a module is only
+# imported once per process.
+SCRIPT = """
+import sys, time
+start = time.time()
+for module in sys.argv[1:]:
+	__import__(module)
+print time.time() - start, len(sys.modules), int('xlwt' in sys.modules)
+"""
+
+
+class Command(BaseCommand):
+	args = '[module ...]'
+	help = "Reports the time it takes to import piston_perfect (or the given modules, such as those that define your handlers) in a fresh process."
+	
+	option_list = BaseCommand.option_list + (
+		make_option('--repeat', type='int', default=5,
+			help="Number of measurements to take (default: 5)."),
+	)
+	
+	def handle(self, *modules, **options):
+		modules = modules or ('piston_perfect', )
+		
+		# The child inherits our environment (including the settings module),
+		# as well as our module search path.
+		env = dict(os.environ)
+		env['PYTHONPATH'] = os.pathsep.join(sys.path)
+		
+		timings = []
+		for i in range(options['repeat']):
+			process = subprocess.Popen(
+				(sys.executable, '-c', SCRIPT) + tuple(modules),
+				stdout=subprocess.PIPE, env=env,
+			)
+			output = process.communicate()[0].split()
+			if process.returncode:
+				raise CommandError("Could not import %s." % ', '.join(modules))
+			timings.append(float(output[0]))
+		
+		timings.sort()
+		self.stdout.write("Imported %s in %.1f ms (median of %d; best %.1f ms).\n" % (
+			', '.join(modules), timings[len(timings) // 2] * 1000, len(timings), timings[0] * 1000))
+		self.stdout.write("%s modules loaded; xlwt %s.\n" % (
+			output[1], output[2] == '1' and "was loaded" or "was not loaded"))
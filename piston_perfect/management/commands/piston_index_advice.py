@@ -0,0 +1,43 @@
+"""
+Reports the index candidates that were found by sampling the data set queries
+of handlers with :attr:`~piston_perfect.handlers.ModelHandler.advise_indexes`.
+"""
+
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from piston_perfect import advisor
+
+
+class Command(BaseCommand):
+	help = "Lists index candidates based on the filters and ordering that clients use, highest ranking first."
+	
+	option_list = BaseCommand.option_list + (
+		make_option('--limit', type='int', default=20,
+			help="Number of candidates to list (default: 20)."),
+		make_option('--clear', action='store_true', default=False,
+			help="Discard all samples after reporting."),
+	)
+	
+	def handle(self, *args, **options):
+		candidates = advisor.report()[:options['limit']]
+		
+		if not candidates:
+			self.stdout.write("No index candidates (yet).\n")
+		
+		for rank, candidate in enumerate(candidates):
+			self.stdout.write("%d. CREATE INDEX ON %s (%s);\n" % (
+				rank + 1, candidate['table'], ', '.join(candidate['columns'])))
+			self.stdout.write("   score %.0f: %d samples at cost %.1f%s%s\n" % (
+				candidate['score'], candidate['count'], candidate['cost'],
+				candidate['scan'] and ", full scan" or "",
+				candidate['sort'] and ", sort" or ""))
+			self.stdout.write("   %s: filters %s, order %s%s\n" % (
+				candidate['handler'],
+				', '.join([repr(definition) for definition in candidate['filters']]) or "none",
+				', '.join(candidate['order']) or "none",
+				candidate['sliced'] and ", sliced" or ""))
+			if int(options['verbosity']) > 1:
+				self.stdout.write("   %s %s\n" % (candidate['sql'], candidate['params']))
+		
+		if options['clear']:
+			advisor.clear()
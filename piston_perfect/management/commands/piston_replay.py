@@ -0,0 +1,56 @@
+"""
+Replays captured API traffic in-process and reports on its performance. See
+:mod:`piston_perfect.replay`.
+"""
+
+from optparse import make_option
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+from piston_perfect import capture, replay
+
+
+class Command(BaseCommand):
+	args = '<log>'
+	help = "Replays the requests in a capture log against the current database, and reports latency, queries and memory per handler."
+	
+	option_list = BaseCommand.option_list + (
+		make_option('--concurrency', type='int', default=1,
+			help="Number of requests to replay at once (default: 1)."),
+		make_option('--handler', action='append', default=[],
+			help="Only replay requests on this handler type (dotted path); can be repeated."),
+		make_option('--user', default=None,
+			help="Username of the user to replay the requests as (default: anonymous)."),
+		make_option('--json', default=None,
+			help="Also write the report as JSON to this file, for comparison with other runs."),
+	)
+	
+	def handle(self, *args, **options):
+		if len(args) != 1:
+			raise CommandError("Provide the path of a capture log.")
+		
+		entries = capture.load(args[0])
+		if options['handler']:
+			entries = [entry for entry in entries if entry['handler'] in options['handler']]
+		
+		user = None
+		if options['user']:
+			try:
+				user = User.objects.get(username=options['user'])
+			except User.DoesNotExist:
+				raise CommandError("No user named %r." % options['user'])
+		
+		report = replay.replay(entries, options['concurrency'], user)
+		
+		self.stdout.write("%-50s %8s %9s %9s %9s %8s %10s\n" % (
+			"handler", "requests", "p50 ms", "p95 ms", "p99 ms", "queries", "memory KB"))
+		for handler, stats in report.items():
+			self.stdout.write("%-50s %8d %9.1f %9.1f %9.1f %8.1f %10s\n" % (
+				handler, stats['requests'],
+				stats['p50'] * 1000, stats['p95'] * 1000, stats['p99'] * 1000,
+				stats['queries'],
+				stats['memory'] is not None and '%.0f' % (stats['memory'] / 1024.) or '-'))
+		
+		if options['json']:
+			with open(options['json'], 'w') as f:
+				simplejson.dump(report, f, indent=4)
@@ -0,0 +1,46 @@
+"""
+Models that support handler features. Only needed if :mod:`piston_perfect` is
+in ``INSTALLED_APPS``, which is required for those features.
+"""
+
+import datetime
+from django.db import models
+from django.db.models.signals import post_delete
+
+
+def model_label(model):
+	return '%s.%s' % (model._meta.app_label, model._meta.object_name.lower())
+
+
+class Tombstone(models.Model):
+	"""
+	Marks the deletion of a model instance, so that clients that keep a copy
+	of the data can be told to remove theirs. See
+	:attr:`.handlers.ModelHandler.since`.
+	"""
+
+	model = models.CharField(max_length=100, db_index=True)
+	object_id = models.CharField(max_length=255)
+	deleted = models.DateTimeField(default=datetime.datetime.now, db_index=True)
+	"""
+	Not used for synchronization (the sequence of the primary key is), but
+	allows for tombstones that are old enough to be pruned.
+	"""
+
+	@classmethod
+	def track(cls, model):
+		"""
+		Has a tombstone left behind whenever an instance of *model* is
+		deleted.
+		"""
+		# Connecting is idempotent thanks to *dispatch_uid*.
+		post_delete.connect(cls.bury, sender=model, weak=False,
+			dispatch_uid='piston:tombstone:%s' % model._meta.db_table)
+
+	@classmethod
+	def bury(cls, sender, instance, **kwargs):
+		# In the same database (and thus transaction) as the deletion.
+		cls.objects.db_manager(instance._state.db).create(
+			model=model_label(sender),
+			object_id=unicode(instance.pk),
+		)
@@ -14,15 +14,32 @@ without touching anything beyond this module.
 from django.db import models
 from django.http import HttpResponse
 from django.conf import settings
+from django.utils.importlib import import_module
 from pistoff.emitters import Emitter
-from custom_emitters import ExcelEmitter, HTMLEmitter
-from .handlers import ModelHandler
+from pistoff.utils import Mimer
+from .handlers import ModelHandler, related_model
+from .cache import fragment_key, get_fragments, set_fragments
+from .identity import IdentityMap
+from . import capture, profiling
+from functools import partial
+from operator import attrgetter
+import pkgutil, threading
 
 
 # These are all the natively supported formats, including their emitter class
 # and content type. Save for later reference.
 ALL_FORMATS = Emitter.EMITTERS.copy()
 
+# Our own formats are registered by the dotted path of their emitter class,
+# which is imported on first use (see the monkey-patched *Emitter.get*). This
+# keeps :mod:`xlwt` and friends out of processes that never need them.
+ALL_FORMATS.update({
+	'excel': ('piston_perfect.custom_emitters.ExcelEmitter', 'application/vnd.ms-excel'),
+	'html': ('piston_perfect.custom_emitters.HTMLEmitter', 'text/html'),
+})
+if pkgutil.find_loader('msgpack'):
+	ALL_FORMATS['msgpack'] = ('piston_perfect.custom_emitters.MsgPackEmitter', 'application/x-msgpack')
+
 # Reset registered emitters, because we want to enforce making supported
 # formats explicit. Also, we want to be able to monkey-patch
 # *Emitter.register* before the first registration is done. Because Piston's
@@ -56,16 +73,43 @@ def in_typemapper(self, *args, **kwargs):
 	   data (which is risky because it might very well result in a huge chunk
 	   of uncurated data ending up in the response) by putting the handler's
 	   fallback model representation in place.
+	
+	Note that the fields specification of the returned handler is not used
+	for nested data that has an explicit fields selection in the request
+	(see :meth:`.handlers.BaseHandler.get_requested_fields`), as Piston
+	passes such a selection on to the nested data directly.
+	
+	If the handler has :attr:`.handlers.BaseHandler.expand` enabled, foreign
+	keys that are not to be expanded are turned into method fields on the
+	returned handler, which Piston prefers over the model fields they
+	shadow.
+	
+	As this is called for every single model instance that is being
+	constructed, the resulting handler types are cached on the emitter.
+	Instances with deferred fields (see :meth:`.handlers.ModelHandler.data_set`)
+	are of a type that Django derives from their model, which is looked up
+	as the model itself.
 	"""
 	
+	if args and getattr(args[0], '_deferred', False):
+		args = (args[0]._meta.proxy_for_model, ) + args[1:]
+	
+	key = args + tuple(sorted(kwargs.items()))
+	cache = self.__dict__.setdefault('_in_typemapper', {})
+	if not key in cache:
+		cache[key] = make_type_handler(self, *args, **kwargs)
+	return cache[key]
+
+def make_type_handler(self, model, *args, **kwargs):
+	
 	# Try to find a handler for the provided model type.
-	handler = native_in_typemapper(self, *args, **kwargs)
+	handler = native_in_typemapper(self, model, *args, **kwargs)
 	
 	# If we have a type handler we might be able to construct a nested fields
 	# selection (but only if the handler's *fields* attribute is not empty).
 	nested = ()
 	if handler:
-		nested = tuple(set(handler.fields) - set(handler.exclude_nested))
+		nested = handler.get_nested_fields()
 	
 	handler = handler or type(self.handler)
 	
@@ -78,8 +122,157 @@ def in_typemapper(self, *args, **kwargs):
 		# typemapper.
 		model = None
 	
+	collapsed = collapsed_relations(self, model)
+	for field in collapsed:
+		if not hasattr(Handler, field.name):
+			setattr(Handler, field.name, staticmethod(attrgetter(field.attname)))
+	
+	# Constructing foreign keys via the identity map means that every related
+	# record is constructed only once.
+	if self.handler.share_related and hasattr(self, 'request'):
+		for field in model._meta.local_fields:
+			if isinstance(field, models.ForeignKey) and not field in collapsed and not hasattr(Handler, field.name):
+				setattr(Handler, field.name, staticmethod(partial(construct_shared, self, field)))
+	
 	return Handler
 
+def collapsed_relations(self, model):
+	"""
+	Returns the foreign keys on *model* that should be represented by their
+	key only, according to the expansion settings of the emitter's handler.
+	"""
+	# Expansion paths start at the handler's model, so this only works for
+	# model handlers.
+	handler_model = getattr(self.handler, 'model', None)
+	if not handler_model or not self.handler.expand or not hasattr(self, 'request'):
+		return ()
+	
+	if not '_expanded' in self.__dict__:
+		# Maps model types onto the names of their relations that should be
+		# expanded.
+		self._expanded = {}
+		def walk(model, selection):
+			for field in selection:
+				name, nested = isinstance(field, tuple) and field or (field, ())
+				self._expanded.setdefault(model, set()).add(name)
+				related = related_model(model, name)
+				if related:
+					walk(related, nested)
+		walk(handler_model, self.handler.get_expanded_fields(self.request))
+	
+	expanded = self._expanded.get(model, ())
+	return [field for field in model._meta.local_fields
+		if isinstance(field, models.ForeignKey) and not field.name in expanded]
+
+def get_identity_map(self):
+	if not hasattr(self.request, 'identity_map'):
+		self.request.identity_map = IdentityMap()
+	return self.request.identity_map
+
+def share_related(self, data):
+	"""
+	Loads the related records that are going to be constructed as part of
+	the model instances in *data* into the request's identity map, one query
+	per relation and level of nesting, and points the instances' foreign keys
+	to them.
+	"""
+	if isinstance(data, models.Model):
+		data = [data]
+	if not isinstance(data, (list, tuple, set, models.query.QuerySet)):
+		return
+	
+	identity_map = get_identity_map(self)
+	
+	def walk(model, instances, fields):
+		handler = self.in_typemapper(model, self.anonymous)
+		for field in fields or handler.fields:
+			name, nested = isinstance(field, tuple) and field or (field, ())
+			# Fields that are rendered by a method are none of our business,
+			# save for the ones that render via the identity map.
+			method = getattr(handler, name, None)
+			if method is not None and getattr(method, 'func', None) is not construct_shared:
+				continue
+			try:
+				field = model._meta.get_field(name, many_to_many=False)
+			except models.FieldDoesNotExist:
+				continue
+			if isinstance(field, models.ForeignKey):
+				new = identity_map.load_related(instances, field)
+				if new:
+					walk(field.rel.to, new, nested)
+	
+	by_model = {}
+	for instance in data:
+		if isinstance(instance, models.Model):
+			by_model.setdefault(type(instance), []).append(instance)
+	for model, instances in by_model.iteritems():
+		walk(model, instances, self.fields)
+
+def construct_shared(self, field, instance):
+	"""
+	Method field that constructs the record that the foreign key *field* of
+	*instance* refers to, or takes its representation from the identity map
+	if it has been constructed before.
+	"""
+	related = getattr(instance, field.name)
+	if related is None:
+		return None
+	return get_identity_map(self).construct(field.rel.to, related, partial(construct_nested, self))
+
+def construct_nested(self, data, fields=()):
+	"""
+	Constructs *data* with fields specification *fields* on a separate
+	emitter that shares this emitter's state.
+	"""
+	emitter = Emitter(data, self.typemapper, self.handler, fields, self.anonymous)
+	emitter.request = self.request
+	for attr in ('_in_typemapper', '_expanded'):
+		if attr in self.__dict__:
+			setattr(emitter, attr, self.__dict__[attr])
+	return native_construct(emitter)
+
+def construct_fragments(self, data):
+	"""
+	Returns the constructed representation of the model data in *data*
+	(an instance or a list of instances), taking the representations of
+	individual instances from the fragment cache where possible and
+	constructing (and caching) the rest. Returns ``None`` if *data* is not
+	suitable for fragment caching.
+	"""
+	model = self.handler.model
+	
+	single = isinstance(data, models.Model)
+	instances = single and [data] or data
+	if not isinstance(instances, (list, tuple, models.query.QuerySet)):
+		return None
+	instances = list(instances)
+	for instance in instances:
+		if not isinstance(instance, model):
+			return None
+	
+	# Everything that determines what a representation looks like.
+	fields = (
+		self.fields or self.in_typemapper(model, self.anonymous).fields,
+		self.handler.get_expanded_fields(self.request),
+	)
+	keys = [fragment_key(type(self.handler), instance, version, fields)
+		for instance, version in zip(instances, self.handler.get_fragment_versions(instances))]
+	
+	local = self.handler.has_local_fragments()
+	fragments = get_fragments(keys, local)
+	
+	misses = [(key, instance) for key, instance in zip(keys, instances) if not key in fragments]
+	if misses:
+		missing = [instance for key, instance in misses]
+		if self.handler.share_related:
+			share_related(self, missing)
+		constructed = dict(zip([key for key, instance in misses], construct_nested(self, missing, self.fields)))
+		set_fragments(constructed, local)
+		fragments.update(constructed)
+	
+	constructed = [fragments[key] for key in keys]
+	return single and constructed[0] or constructed
+
 Emitter.in_typemapper = in_typemapper
 
 
@@ -125,31 +318,60 @@ def construct(self):
 		# Else we need to do the fields selection ourselves, as Piston's
 		# emitter doesn't do fields selection on non-model data.
 		
-		def process_requested_fields(data):
+		def process_requested_fields(data, fields):
 			if isinstance(data, (list, tuple, set, models.query.QuerySet)):
-				return map(process_requested_fields, data)
+				return [process_requested_fields(item, fields) for item in data]
 			
 			# We make the assumption that an *items* attribute indicates that
 			# we can look for fields.
 			if not hasattr(data, 'items'):
 				return data
 			
-			return dict([(field, value)
+			# Nested selections are given as a tuple of the field name and the
+			# selection, and are applied to the nested data recursively.
+			nested = dict([field for field in fields if isinstance(field, tuple)])
+			
+			return dict([(field, process_requested_fields(value, nested[field]) if field in nested else value)
 				for field, value in data.items()
-				if field in fields or not fields and self.handler.may_output_field(field)])
+				if field in fields or field in nested or not fields and self.handler.may_output_field(field)])
 		
 		# Update the to-be-constructed response in *this.data* with the
 		# fields-selected data.
 		self.handler.set_response_data(self.request,
-			process_requested_fields(data),
+			process_requested_fields(data, fields),
 			self.data
 		)
 	
+	data = self.handler.get_response_data(self.request, self.data)
+	
+	fragments = None
+	if getattr(self.handler, 'fragment_cache', False) and self.request.method.upper() == 'GET':
+		fragments = construct_fragments(self, data)
+	
+	if fragments is None:
+		if self.handler.share_related:
+			share_related(self, data)
+		constructed = native_construct(self)
+	else:
+		# Construct the response around the already constructed data, but
+		# leave the unconstructed response intact for the post-construction
+		# hook.
+		unconstructed = self.data
+		self.data = self.handler.set_response_data(self.request, fragments, dict(unconstructed))
+		try:
+			constructed = native_construct(self)
+		finally:
+			self.data = unconstructed
+	
 	# Invokes a post-construction hook on the handler whose return value is
 	# the definitive response ready for serialization.
-	return self.handler.response_constructed(native_construct(self), self.data, self.request)
+	return self.handler.response_constructed(constructed, self.data, self.request)
 
-Emitter.construct = construct
+def profiled_construct(self):
+	with profiling.phase(getattr(self, 'request', None), 'construct'):
+		return construct(self)
+
+Emitter.construct = profiled_construct
 
 
 # Monkey-patch *Emitter.register*.
@@ -161,8 +383,20 @@ def register(cls, name, klass, content_type='text/plain'):
 	We need to monkey-patch this method in order to be able to monkey-patch
 	:meth:`pistoff.emitters.Emitter.render`, as the latter has got no
 	implementation and is not being invoked by its inheritors.
+	
+	*klass* can also be the dotted path of an emitter class, in which case
+	patching is postponed until it is imported.
 	"""
 	
+	if not isinstance(klass, basestring):
+		patch_render(klass)
+	
+	return native_register(name, klass, content_type)
+
+Emitter.register = classmethod(register)
+
+def patch_render(klass):
+	
 	native_render = klass.render
 
 	def render(self, request):
@@ -176,17 +410,83 @@ def register(cls, name, klass, content_type='text/plain'):
 			return self.data
 		
 		self.request = request
-		return native_render(self, request)
+		with profiling.phase(request, 'render'):
+			return native_render(self, request)
 	
 	klass.render = render
 	
-	return native_register(name, klass, content_type)
+	return klass
 
-Emitter.register = classmethod(register)
 
+# Monkey-patch *Emitter.get*.
+
+native_get = Emitter.get
+get_lock = threading.Lock()
+
+def get(cls, format):
+	"""
+	Imports (and patches) the emitter class of *format* if it was registered
+	by its dotted path and has not been used before.
+	"""
+	klass, content_type = native_get(format)
+	if isinstance(klass, basestring):
+		with get_lock:
+			klass, content_type = native_get(format)
+			if isinstance(klass, basestring):
+				klass = patch_render(load(klass))
+				cls.EMITTERS[format] = (klass, content_type)
+	return klass, content_type
+
+Emitter.get = classmethod(get)
+
+def load(path):
+	"""
+	Returns the object at dotted path *path*.
+	"""
+	module, name = path.rsplit('.', 1)
+	return getattr(import_module(module), name)
+
+
+# Select the JSON encoder backend: ``'simplejson'`` (the default) leaves
+# Piston's emitter in place, ``'fast'`` replaces it with one that can use the
+# C-accelerated encoder.
+if getattr(settings, 'PISTON_JSON_ENCODER', 'simplejson') == 'fast' and 'json' in ALL_FORMATS:
+	ALL_FORMATS['json'] = ('piston_perfect.custom_emitters.FastJSONEmitter', ALL_FORMATS['json'][1])
 
 # Register response formats. Is guaranteed to use the monkey-patched
 # *Emitter.register*, which means the registered emitter type classes will be
 # fully monkey-patched as well.
 for format in set(getattr(settings, 'PISTON_FORMATS', ('json', 'excel', 'html' ))).intersection(ALL_FORMATS.keys()):
 	Emitter.register(format, *ALL_FORMATS.get(format))
+
+# Monkey-patch *Mimer.translate*.
+
+native_translate = Mimer.translate
+
+def translate(self):
+	"""
+	Leaves the body of a request that is to be read incrementally (see
+	:attr:`.handlers.ModelHandler.ingest`) alone, as Piston would otherwise
+	read and parse it in full. Also captures the shape of the parsed body if
+	traffic is being captured (see :mod:`.capture`).
+	"""
+	ingest = getattr(self.request, 'ingest', None)
+	if ingest is None:
+		request = native_translate(self)
+		# The handler turns the data into something else, so this is our
+		# only chance to capture its shape.
+		if capture.log_path() and getattr(request, 'data', None) is not None:
+			request.body_shape = capture.shape(request.data)
+		return request
+	
+	self.request.content_type = self.content_type()
+	self.request.data = ingest
+	return self.request
+
+Mimer.translate = translate
+
+
+# Request bodies are parsed by Piston before any emitter is involved, so the
+# MessagePack loader is registered right away, but imported on first use.
+if 'msgpack' in ALL_FORMATS:
+	Mimer.register(lambda data: load('piston_perfect.custom_emitters.msgpack_loads')(data), ('application/x-msgpack',))
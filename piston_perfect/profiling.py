@@ -0,0 +1,184 @@
+"""
+Memory profiling of requests, by phase. See
+:attr:`.handlers.BaseHandler.profile_memory`. The following settings
+attribute applies:
+
+   PISTON_MEMORY_TOP_SITES = 5    # Allocation sites reported per phase.
+
+The phases are ``data`` (the handler's operation), ``construct`` (turning the
+resulting data into dictionaries and lists) and ``render`` (serialization,
+which includes ``construct`` as emitters construct while they render). For
+every phase the ``peak`` and ``retained`` number of bytes is reported.
+
+Allocations are traced with :mod:`tracemalloc` if it is available, which it
+is not before Python 3.4 (save for patched builds of Python 2.7 with the
+``pytracemalloc`` backport). The sites (file and line) that retained the
+most are then reported as well. On Pythons before 3.9 the peak is the peak
+since the start of the request rather than of the phase.
+
+Without :mod:`tracemalloc`, the memory of the process as a whole is measured
+instead, by its resident set size: ``peak`` is how much the phase raised the
+highest resident set size of the process so far (so a phase that stays
+below an earlier high reports ``0``), and ``retained`` is how much the
+resident set size changed (only on Linux; ``None`` elsewhere). These numbers
+include whatever other threads did in the meantime, and memory that Python
+keeps around for reuse, so they are rough.
+
+Profiling memory is a process-wide affair, so only one request at a time is
+profiled; a request that is sampled while another one is being profiled is
+not.
+"""
+
+from __future__ import absolute_import
+
+import os, random, sys, threading
+from django.conf import settings
+from django.utils.datastructures import SortedDict
+
+
+# The modules that memory is measured with, which are only imported once
+# memory is going to be profiled (see :func:`available`).
+tracemalloc = None
+resource = None
+_imported = False
+
+_lock = threading.Lock()
+
+
+def available():
+	"""
+	Returns whether memory can be profiled at all.
+	"""
+	global tracemalloc, resource, _imported
+	if not _imported:
+		try:
+			import tracemalloc
+		except ImportError:
+			pass
+		try:
+			import resource
+		except ImportError:
+			pass
+		_imported = True
+	return tracemalloc is not None or resource is not None
+
+def rss():
+	"""
+	Returns the resident set size of the process in bytes, or ``None`` if it
+	cannot be told.
+	"""
+	try:
+		with open('/proc/self/statm') as f:
+			return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (IOError, OSError, IndexError, ValueError):
+		return None
+
+def max_rss():
+	"""
+	Returns the highest resident set size of the process so far in bytes.
+	"""
+	usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# Is in bytes on Mac OS X, and in kilobytes elsewhere.
+	return sys.platform == 'darwin' and usage or usage * 1024
+
+def usage():
+	"""
+	Returns the current and the peak memory usage in bytes: of the traced
+	allocations if :mod:`tracemalloc` is tracing, or of the resident set of
+	the process otherwise.
+	"""
+	if tracemalloc is not None and tracemalloc.is_tracing():
+		return tracemalloc.get_traced_memory()
+	return rss(), max_rss()
+
+
+class MemoryProfile(object):
+	"""
+	The memory profile of a request, which is filled in as it goes through
+	its phases.
+	"""
+
+	def __init__(self):
+		self.phases = SortedDict()
+		self.stack = []
+		self.started = False
+		self.tracing = tracemalloc is not None
+
+	@classmethod
+	def start(cls, request, sample):
+		"""
+		Returns the memory profile for *request*, or ``None`` if it is not
+		going to be profiled, which is decided by chance with probability
+		*sample*.
+		"""
+		if not sample or not available() or random.random() >= sample:
+			return None
+		if not _lock.acquire(False):
+			return None
+		profile = cls()
+		if profile.tracing and not tracemalloc.is_tracing():
+			tracemalloc.start()
+			profile.started = True
+		request.memory_profile = profile
+		return profile
+
+	def stop(self):
+		if self.started:
+			tracemalloc.stop()
+		_lock.release()
+
+
+class phase(object):
+	"""
+	Context manager that profiles the code it runs as phase *name* of the
+	memory profile of *request*, if any. Phases can be nested, but a phase
+	that is nested in a phase of the same name is not profiled separately.
+	"""
+
+	def __init__(self, request, name):
+		self.profile = getattr(request, 'memory_profile', None)
+		self.name = name
+
+	def __enter__(self):
+		if self.profile is None or self.name in [outer.name for outer in self.profile.stack]:
+			self.profile = None
+			return
+		self.top = self.profile.tracing and getattr(settings, 'PISTON_MEMORY_TOP_SITES', 5)
+		self.snapshot = self.top and tracemalloc.take_snapshot()
+		self.reset_peak()
+		self.start, self.peak = usage()
+		# The peak that we measure from: the current usage if allocations
+		# are traced, or the highest resident set size so far otherwise.
+		self.base = self.peak
+		if self.profile.tracing:
+			self.base = self.start
+		self.profile.stack.append(self)
+
+	def __exit__(self, *exc_info):
+		if self.profile is None:
+			return
+		self.profile.stack.pop()
+		current, peak = usage()
+		peak = max(self.peak, self.reset_peak(peak))
+		retained = None
+		if current is not None and self.start is not None:
+			retained = current - self.start
+		stats = dict(peak=peak - self.base, retained=retained)
+		if self.top:
+			stats['top'] = [str(stat)
+				for stat in tracemalloc.take_snapshot().compare_to(self.snapshot, 'lineno')[:self.top]]
+		self.profile.phases[self.name] = stats
+
+	def reset_peak(self, peak=None):
+		"""
+		Passes *peak* (or if ``None``, the current peak) on to the phases that
+		this one is nested in, and resets the peak if possible. Returns the
+		peak.
+		"""
+		if peak is None:
+			peak = usage()[1]
+		for outer in self.profile.stack:
+			outer.peak = max(outer.peak, peak)
+		if self.profile.tracing and hasattr(tracemalloc, 'reset_peak'):
+			tracemalloc.reset_peak()
+		return peak
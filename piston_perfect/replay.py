@@ -0,0 +1,139 @@
+"""
+In-process replay of captured API traffic (see :mod:`.capture`), for
+comparing the performance of different versions of the code on the same
+workload. Meant to be run against a disposable copy of the database, as
+writes are replayed too.
+
+Request bodies are not captured, only their shape, so replayed bodies are
+made up of placeholder values of the right types.
+"""
+
+import time, urllib
+from multiprocessing.pool import ThreadPool
+from django.contrib.auth.models import AnonymousUser
+from django.db import connection
+from django.test.client import RequestFactory
+from django.utils import simplejson
+from django.utils.datastructures import SortedDict
+from django.utils.importlib import import_module
+from .capture import REDACTED
+from . import profiling
+from .profiling import MemoryProfile
+
+
+PLACEHOLDERS = dict(
+	unicode=u'', str='', int=0, long=0, float=0.0, bool=False, NoneType=None,
+)
+
+def placeholder(shape):
+	"""
+	Returns data of shape *shape* (see :func:`.capture.shape`).
+	"""
+	if isinstance(shape, dict):
+		if set(shape.keys()) == set(['items', 'length']):
+			return [placeholder(shape['items']) for i in range(shape['length'])]
+		return dict([(key, placeholder(value)) for key, value in shape.iteritems()])
+	return PLACEHOLDERS.get(shape)
+
+def resolve(handler):
+	module, name = handler.rsplit('.', 1)
+	return getattr(import_module(module), name)
+
+def build_request(entry, user=None):
+	"""
+	Returns a request object that is equivalent to captured request *entry*.
+	"""
+	factory = RequestFactory()
+	method = getattr(factory, entry['method'].lower())
+	query = urllib.urlencode([(key, value.encode('utf-8'))
+		for key, value in entry['query'] if value != REDACTED])
+
+	if entry['method'] in ('POST', 'PUT'):
+		body = entry['body'] is not None and simplejson.dumps(placeholder(entry['body'])) or ''
+		request = method(entry['path'], body, 'application/json', QUERY_STRING=query)
+	else:
+		request = method(entry['path'], QUERY_STRING=query)
+
+	request.user = user or AnonymousUser()
+	return request
+
+def replay_one(entry, user, profile):
+	"""
+	Replays captured request *entry*, and returns its handler, duration,
+	number of queries and peak memory usage (if *profile*, see
+	:mod:`.profiling`).
+	"""
+	resource = resolve(entry['handler']).resource
+	request = build_request(entry, user)
+
+	connection.use_debug_cursor = True
+	connection.queries = []
+	profile = profile and MemoryProfile.start(request, 1)
+
+	start = time.time()
+	try:
+		with profiling.phase(request, 'request'):
+			# Bypasses capture, as the replay would end up in the log
+			# otherwise.
+			response = resource.serve(request, *entry['args'], **dict([(str(key), value)
+				for key, value in entry['kwargs'].iteritems()]))
+			# Streaming responses do their work while they are being
+			# consumed.
+			for chunk in response:
+				pass
+	finally:
+		if profile:
+			profile.stop()
+	duration = time.time() - start
+
+	peak = None
+	if profile:
+		peak = profile.phases['request']['peak']
+
+	return entry['handler'], duration, len(connection.queries), peak
+
+def percentile(values, fraction):
+	"""
+	Returns the *fraction* percentile of the sorted list *values*, by the
+	nearest-rank method.
+	"""
+	return values[max(int(round(fraction * len(values))) - 1, 0)]
+
+def replay(entries, concurrency=1, user=None):
+	"""
+	Replays the captured requests in *entries* with *concurrency* requests at
+	a time, and returns a report per handler type (in order of appearance),
+	with the number of ``requests``, the ``p50``, ``p95`` and ``p99``
+	latencies in seconds, the mean number of ``queries`` and the mean
+	``memory`` peak in bytes. Memory is only measured if *concurrency* is
+	``1`` (as it would not tell us anything otherwise). Without
+	:mod:`tracemalloc`, the memory peak is how much a request raised the
+	highest resident set size of the process (see :mod:`.profiling`), which
+	is ``0`` for requests that stay below an earlier high.
+	"""
+	profile = profiling.available() and concurrency == 1
+	pool = ThreadPool(concurrency)
+	try:
+		results = pool.map(lambda entry: replay_one(entry, user, profile), list(entries))
+	finally:
+		pool.close()
+
+	handlers = SortedDict()
+	for handler, duration, queries, peak in results:
+		handlers.setdefault(handler, []).append((duration, queries, peak))
+
+	report = SortedDict()
+	for handler, samples in handlers.items():
+		durations = sorted([duration for duration, queries, peak in samples])
+		peaks = [peak for duration, queries, peak in samples if peak is not None]
+		report[handler] = dict(
+			requests=len(samples),
+			p50=percentile(durations, .5),
+			p95=percentile(durations, .95),
+			p99=percentile(durations, .99),
+			queries=float(sum([queries for duration, queries, peak in samples])) / len(samples),
+			memory=None,
+		)
+		if peaks:
+			report[handler]['memory'] = sum(peaks) / len(peaks)
+	return report
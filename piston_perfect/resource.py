@@ -1,9 +1,38 @@
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
 from django.db import connection
-from django.http import Http404, HttpResponseBadRequest, HttpResponseGone, HttpResponseNotAllowed, HttpResponseNotFound
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseGone, HttpResponseNotAllowed, HttpResponseNotFound
 from pistoff import resource
-from .utils import MethodNotAllowed
-import datetime
+from . import capture
+from .admission import Limiter
+from .budget import QueryBudget
+from .compression import compress
+from .ingest import Ingest
+from .profiling import MemoryProfile
+from .routing import written
+from .signals import memory_profiled, request_admitted, request_rejected
+from .spec import RequestSpec
+from .utils import MethodNotAllowed, QueryBudgetExceeded
+import datetime, sys, threading, time
+
+
+class Flight(object):
+	"""
+	A request whose response is being computed, and which concurrent
+	identical requests can wait for.
+	"""
+	
+	def __init__(self):
+		self.done = threading.Event()
+		self.response = None
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+def copy_response(response):
+	copy = HttpResponse(response.content, status=response.status_code)
+	for header, value in response.items():
+		copy[header] = value
+	return copy
 
 
 class Resource(resource.Resource):
@@ -16,7 +45,24 @@ class Resource(resource.Resource):
 	Route every request type to :meth:`.handlers.BaseHandler.request`.
 	"""
 	
+	def __init__(self, handler, authentication=None):
+		super(Resource, self).__init__(handler, authentication)
+		
+		self.limiter = None
+		if self.handler.max_concurrency:
+			self.limiter = Limiter(self.handler.max_concurrency, self.handler.max_queue)
+	
 	def __call__(self, request, *args, **kwargs):
+		"""
+		Serves *request*, and captures it for later replay if so configured
+		(see :mod:`.capture`).
+		"""
+		start = time.time()
+		response = self.serve(request, *args, **kwargs)
+		capture.record(type(self.handler), request, args, kwargs, response, time.time() - start)
+		return response
+	
+	def serve(self, request, *args, **kwargs):
 		"""
 		As soon as the resource is being called we can say that Piston has
 		taken over. We take this moment to reset the query log, so we can read
@@ -25,7 +71,88 @@ class Resource(resource.Resource):
 		before, like in unrelated middleware).
 		"""
 		connection.queries = []
-		response = super(Resource, self).__call__(request, *args, **kwargs)
+		
+		exporting = request.method.upper() == 'GET' and self.handler.export and self.handler.export in request.GET
+		coalescing = request.method.upper() == 'GET' and self.handler.coalesce
+		
+		# An export is started right here, instead of by Piston, and a
+		# coalesced request may be answered with the response to another one,
+		# so these have to be authenticated up front: their request spec
+		# should tell whose response it is going to be.
+		if exporting or coalescing:
+			actor, anonymous = self.authenticate(request, 'GET')
+			if anonymous is resource.CHALLENGE:
+				return actor()
+			request.is_anonymous = anonymous
+		
+		if self.limiter:
+			start = time.time()
+			admitted = self.limiter.acquire(self.handler.queue_timeout)
+			wait_time = time.time() - start
+			
+			if not admitted:
+				request_rejected.send(sender=type(self.handler), request=request, wait_time=wait_time)
+				response = HttpResponse(status=503)
+				response['Retry-After'] = str(self.handler.retry_after)
+				return response
+			
+			request_admitted.send(sender=type(self.handler), request=request, wait_time=wait_time)
+		
+		try:
+			# Exports run in the background, on a pool of their own.
+			if exporting:
+				# Is imported here rather than at module level, so that
+				# processes that never export do not have to pay for it.
+				from . import export
+				return export.start(self, request, *args, **kwargs)
+			if coalescing:
+				response = self.coalesce(request, *args, **kwargs)
+			else:
+				response = self.respond(request, *args, **kwargs)
+		finally:
+			if self.limiter:
+				self.limiter.release()
+		
+		# Compression comes last, as it should see the body that is actually
+		# going to be sent.
+		return compress(request, response,
+			self.determine_emitter(request, *args, **kwargs),
+			type(self.handler),
+		)
+	
+	def respond(self, request, *args, **kwargs):
+		"""
+		Has Piston produce the response to *request*, and adds whatever Piston
+		won't add by itself.
+		"""
+		if request.method.upper() == 'POST' and getattr(self.handler, 'ingest', False):
+			request.ingest = Ingest.from_request(request)
+		
+		budget = QueryBudget(
+			self.handler.max_queries,
+			self.handler.max_query_time,
+			self.handler.statement_timeout,
+		)
+		profile = MemoryProfile.start(request, self.handler.profile_memory)
+		try:
+			# The budget also covers the queries that are made while the
+			# emitter constructs the response, which happens outside of
+			# Piston's error handling.
+			with budget:
+				response = super(Resource, self).__call__(request, *args, **kwargs)
+		except QueryBudgetExceeded, e:
+			response = self.error_handler(e, request, self.handler.request, self.determine_emitter(request, *args, **kwargs))
+		finally:
+			if profile:
+				profile.stop()
+		
+		if profile:
+			memory_profiled.send(sender=type(self.handler), request=request, phases=profile.phases)
+		
+		# Has the author of a write read its own writes from the primary
+		# database for a while.
+		if request.method.upper() != 'GET' and response.status_code < 400:
+			written(request)
 
 		# This is the only chance we have to interact with the HTTPResponse
 		# object `response`. So far we were only dealing with data, which were
@@ -38,6 +165,50 @@ class Resource(resource.Resource):
 		
 		return response
 	
+	def coalesce(self, request, *args, **kwargs):
+		"""
+		Makes concurrent identical requests (as in: having equal
+		:class:`.spec.RequestSpec`) share one response. The first one
+		computes it, the others wait for it for at most
+		:attr:`.handlers.BaseHandler.coalesce_timeout` seconds and get a copy.
+		If waiting times out, or if the first request does not produce a
+		successful non-streaming response, they compute their own.
+		
+		Only requests on behalf of the same user, or anonymous requests, are
+		considered identical. *request* should have been authenticated
+		already.
+		"""
+		spec = RequestSpec.from_request(self, request, *args, **kwargs)
+		
+		# An authenticator that does not tell who the user is leaves us
+		# nothing to tell callers apart by.
+		if spec.scope is None and not request.is_anonymous:
+			return self.respond(request, *args, **kwargs)
+		
+		with _flights_lock:
+			flight = _flights.get(spec)
+			leader = flight is None
+			if leader:
+				flight = _flights[spec] = Flight()
+		
+		if leader:
+			try:
+				response = self.respond(request, *args, **kwargs)
+				if response.status_code == 200 and response._is_string:
+					# A copy, as the response itself is yet to be compressed
+					# (in place) for the encoding that this request accepts.
+					flight.response = copy_response(response)
+				return response
+			finally:
+				with _flights_lock:
+					del _flights[spec]
+				flight.done.set()
+		
+		if flight.done.wait(self.handler.coalesce_timeout) and flight.response is not None:
+			return copy_response(flight.response)
+		
+		return self.respond(request, *args, **kwargs)
+	
 	def error_handler(self, e, *args, **kwargs):
 		"""
 		If anything went wrong inside the handler, this method will try to
@@ -61,6 +232,16 @@ class Resource(resource.Resource):
 		if isinstance(e, Http404):
 			return HttpResponseNotFound()
 		
+		# Work that was delegated to another thread did not finish in time.
+		# Only a pool can time out, so if there is none, there is no need to
+		# import it.
+		multiprocessing = sys.modules.get('multiprocessing')
+		if multiprocessing is not None and isinstance(e, multiprocessing.TimeoutError):
+			return HttpResponse(status=503)
+		
+		if isinstance(e, QueryBudgetExceeded):
+			return HttpResponse(status=503)
+		
 		# Else, force parent method to handle as a 500 (because the others are
 		# useless).
 		return super(Resource, self).error_handler(None, *args, **kwargs)
@@ -0,0 +1,63 @@
+"""
+Routing of read operations to database replicas. The following settings
+attributes apply:
+
+   PISTON_READ_DATABASES = ()      # Aliases of the replicas to read from.
+   PISTON_READ_STICKINESS = 5      # Seconds.
+
+``GET`` requests on model handlers read from a randomly chosen replica, all
+other requests use the default database. To make sure that clients get to see
+their own writes despite replication lag, a user (or anonymous session) that
+has written anything reads from the default database for the next
+``PISTON_READ_STICKINESS`` seconds. This is tracked in Django's cache, so it
+holds across processes.
+"""
+
+import random
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+
+def replicas():
+	return getattr(settings, 'PISTON_READ_DATABASES', ())
+
+def stickiness():
+	return getattr(settings, 'PISTON_READ_STICKINESS', 5)
+
+def writer_key(request):
+	"""
+	Returns the cache key that identifies the author of *request*, or
+	``None`` if it is anonymous.
+	"""
+	user = getattr(request, 'user', None)
+	if user is not None and user.is_authenticated():
+		return 'piston:sticky:user:%s' % user.pk
+	session = getattr(request, 'session', None)
+	if session is not None and session.session_key:
+		return 'piston:sticky:session:%s' % session.session_key
+	return None
+
+def read_database(request):
+	"""
+	Returns the alias of the database that *request* should read from, or
+	``None`` if it is not up to us to decide (which leaves it to Django's
+	database routers).
+	"""
+	if request.method.upper() != 'GET' or not replicas():
+		return None
+	key = writer_key(request)
+	if key is not None and cache.get(key):
+		return DEFAULT_DB_ALIAS
+	return random.choice(replicas())
+
+def written(request):
+	"""
+	Records that *request* has written data, so that its author reads from
+	the default database for a while.
+	"""
+	if not replicas():
+		return
+	key = writer_key(request)
+	if key is not None:
+		cache.set(key, True, stickiness())
@@ -0,0 +1,35 @@
+"""
+Instrumentation hooks. Every signal is sent with the handler type that served
+the request as its sender, so receivers can be connected for a specific
+handler only.
+"""
+
+from django.dispatch import Signal
+
+
+response_compressed = Signal(providing_args=['request', 'encoding', 'size', 'compressed_size', 'cpu_time'])
+"""
+Sent when a response body has been compressed. *size* and *compressed_size*
+are in bytes, *cpu_time* is in seconds. For streaming responses it is sent
+once the last chunk has been compressed.
+"""
+
+request_admitted = Signal(providing_args=['request', 'wait_time'])
+"""
+Sent when a request on a handler with limited concurrency is admitted.
+*wait_time* is the number of seconds it spent waiting in line.
+"""
+
+request_rejected = Signal(providing_args=['request', 'wait_time'])
+"""
+Sent when a request on a handler with limited concurrency is turned away,
+either because the line was full (in which case *wait_time* is next to
+nothing) or because it did not get its turn in time.
+"""
+
+memory_profiled = Signal(providing_args=['request', 'phases'])
+"""
+Sent when the memory usage of a request has been profiled. *phases* maps the
+names of the phases onto their ``peak`` and ``retained`` allocation in bytes
+and their ``top`` allocation sites. See :mod:`.profiling`.
+"""
@@ -0,0 +1,69 @@
+"""
+Normalized descriptions of API requests.
+"""
+
+import hashlib
+from django.utils import translation
+
+
+class RequestSpec(object):
+	"""
+	Describes a request by the things that determine its response: the
+	handler type, the method, the arguments from the URL pattern, the query
+	string, the response format, the language (which labels such as verbose
+	names are translated to) and the authorization scope (the user on whose
+	behalf the request is made, or ``None`` if it is anonymous). Two
+	requests with equal specs are expected to yield the same response, given
+	the same data.
+
+	The query string is normalized, so the order of its parameters does not
+	matter, except for the order of multiple values of the same parameter
+	(which may very well matter, as in ``?order=name&order=id``).
+	"""
+
+	def __init__(self, handler, method, args, kwargs, query, em_format, language, scope):
+		self.handler = handler
+		self.method = method.upper()
+		self.args = tuple(args)
+		self.kwargs = tuple(sorted(kwargs.items()))
+		self.query = tuple(sorted([(key, tuple(values)) for key, values in query.iterlists()]))
+		self.format = em_format
+		self.language = language
+		self.scope = scope
+
+	@classmethod
+	def from_request(cls, resource, request, *args, **kwargs):
+		"""
+		Returns the spec of *request* on *resource*, which is called with
+		*args* and *kwargs*. The scope is only right if *request* has been
+		authenticated already (see :meth:`.resource.Resource.serve`).
+		"""
+		em_format = resource.determine_emitter(request, *args, **kwargs)
+		kwargs.pop('emitter_format', None)
+
+		scope = None
+		user = getattr(request, 'user', None)
+		if not getattr(request, 'is_anonymous', False) and user is not None and user.is_authenticated():
+			scope = user.pk
+
+		return cls(type(resource.handler), request.method, args, kwargs, request.GET, em_format,
+			translation.get_language_from_request(request), scope)
+
+	def key(self):
+		"""
+		Returns a text string that identifies this spec, suitable as a cache
+		key.
+		"""
+		return hashlib.md5(repr((
+			self.handler.__module__, self.handler.__name__,
+			self.method, self.args, self.kwargs, self.query, self.format, self.language, self.scope,
+		))).hexdigest()
+
+	def __eq__(self, other):
+		return isinstance(other, RequestSpec) and self.key() == other.key()
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __hash__(self):
+		return hash(self.key())
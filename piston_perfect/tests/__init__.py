@@ -0,0 +1,11 @@
+"""
+Run with ``python runtests.py``, which uses the settings in
+:mod:`.tests.settings`, or with ``manage.py test piston_perfect`` from a
+project that has ``'piston_perfect'`` in ``INSTALLED_APPS``. In the latter
+case, the routing tests are skipped unless a second database named
+``'replica'`` is configured as well.
+"""
+
+from .cache import *
+from .emitters import *
+from .routing import *
@@ -0,0 +1,61 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.test import TestCase
+from ..cache import ObjectCache, fragment_key
+from ..handlers import BaseHandler
+from ..models import Tombstone
+
+
+class Handler(BaseHandler):
+	read = True
+
+
+class FragmentCacheTest(TestCase):
+	"""
+	Every :class:`.cache.ObjectCache` stands in for a process of its own.
+	"""
+
+	fields = ('model', 'object_id'), ()
+
+	def setUp(self):
+		self.shared = getattr(settings, 'PISTON_OBJECT_CACHE_SHARED', None)
+		cache.clear()
+		self.instance = Tombstone(pk=1, model='app.model', object_id='1')
+
+	def tearDown(self):
+		if self.shared is None:
+			if hasattr(settings, 'PISTON_OBJECT_CACHE_SHARED'):
+				del settings.PISTON_OBJECT_CACHE_SHARED
+		else:
+			settings.PISTON_OBJECT_CACHE_SHARED = self.shared
+		cache.clear()
+
+	def key(self, process):
+		return fragment_key(Handler, self.instance, process.version(Tombstone), self.fields)
+
+	def test_local_versions(self):
+		settings.PISTON_OBJECT_CACHE_SHARED = False
+		this, other = ObjectCache(), ObjectCache()
+
+		# The other process saves, and constructs a representation after
+		# that, which this process's save makes stale.
+		other.invalidate(Tombstone)
+		other.set_fragments({self.key(other): 'stale'})
+		this.invalidate(Tombstone)
+
+		# Both processes are at the same local version...
+		self.assertEqual(self.key(this), self.key(other))
+		# ...but do not share representations.
+		self.assertEqual(this.get_fragments([self.key(this)]), {})
+		self.assertEqual(other.get_fragments([self.key(other)]), {self.key(other): 'stale'})
+
+	def test_shared_versions(self):
+		settings.PISTON_OBJECT_CACHE_SHARED = True
+		this, other = ObjectCache(), ObjectCache()
+
+		stale = self.key(other)
+		this.invalidate(Tombstone)
+
+		# A save in this process moves the other one on too.
+		self.assertEqual(self.key(this), self.key(other))
+		self.assertNotEqual(self.key(other), stale)
@@ -0,0 +1,74 @@
+import datetime, decimal
+from django.conf import settings
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.utils import simplejson
+from django.utils.translation import ugettext_lazy
+from pistoff.emitters import JSONEmitter
+from pistoff.handler import typemapper
+from ..custom_emitters import FastJSONEmitter
+from ..handlers import BaseHandler
+
+
+class Handler(BaseHandler):
+	read = True
+
+
+class FastJSONEmitterTest(TestCase):
+	"""
+	The fast JSON emitter should be a drop-in replacement for Piston's.
+	"""
+	
+	values = (
+		datetime.datetime(2012, 3, 4, 5, 6, 7, 890),
+		datetime.datetime(1850, 1, 2, 3, 4, 5),
+		datetime.datetime(33, 1, 2, 3, 4, 5),
+		datetime.date(2012, 3, 4),
+		datetime.date(999, 3, 4),
+		datetime.time(5, 6, 7, 890),
+		decimal.Decimal('1.10'),
+		decimal.Decimal('-0.0000001'),
+		ugettext_lazy(u'Caf\xe9'),
+		u'\u2603', 'bytes', 1, 2 ** 64, 1.5, None, True,
+	)
+	
+	def setUp(self):
+		self.compact = getattr(settings, 'PISTON_JSON_COMPACT', None)
+		settings.PISTON_JSON_COMPACT = False
+	
+	def tearDown(self):
+		if self.compact is None:
+			del settings.PISTON_JSON_COMPACT
+		else:
+			settings.PISTON_JSON_COMPACT = self.compact
+	
+	def render(self, emitter_class, data, query=None):
+		request = RequestFactory().get('/', query or {})
+		emitter = emitter_class(dict(data=data), typemapper, Handler(), (), False)
+		emitter.request = request
+		return emitter.render(request)
+	
+	def assertSameOutput(self, data, query=None):
+		self.assertEqual(
+			self.render(FastJSONEmitter, data, query),
+			self.render(JSONEmitter, data, query),
+		)
+	
+	def test_values(self):
+		for value in self.values:
+			self.assertSameOutput(value)
+	
+	def test_list(self):
+		self.assertSameOutput(list(self.values))
+	
+	def test_dict(self):
+		self.assertSameOutput(dict([('value%d' % i, value) for i, value in enumerate(self.values)]))
+	
+	def test_jsonp(self):
+		self.assertSameOutput(list(self.values), dict(callback='callback'))
+	
+	def test_compact(self):
+		settings.PISTON_JSON_COMPACT = True
+		compact = self.render(FastJSONEmitter, list(self.values))
+		self.assertFalse('\n' in compact)
+		self.assertEqual(simplejson.loads(compact), simplejson.loads(self.render(JSONEmitter, list(self.values))))
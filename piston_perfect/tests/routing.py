@@ -0,0 +1,82 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.test import TestCase
+from django.test.client import RequestFactory
+from pistoff.handler import typemapper
+from .. import routing
+from ..handlers import ModelHandler
+from ..identity import IdentityMap
+from ..models import Tombstone
+
+
+REPLICA = 'replica'
+
+class User(object):
+	pk = 1
+	
+	def is_authenticated(self):
+		return True
+
+
+class RoutingTest(TestCase):
+	"""
+	Requires a project with two SQLite databases: ``'default'`` and
+	``'replica'``, which stands in for a replica (but is not replicated to).
+	"""
+	
+	multi_db = True
+	
+	def setUp(self):
+		if not REPLICA in settings.DATABASES:
+			self.skipTest("No '%s' database configured." % REPLICA)
+		settings.PISTON_READ_DATABASES = REPLICA,
+		cache.clear()
+		
+		self.primary = Tombstone.objects.using(DEFAULT_DB_ALIAS).create(model='primary', object_id='1')
+		self.replicated = Tombstone.objects.using(REPLICA).create(model='replica', object_id='1')
+		
+		# Defined here, as defining a handler registers it in the (global)
+		# typemapper.
+		class TombstoneHandler(ModelHandler):
+			model = Tombstone
+			read = True
+		self.handler = TombstoneHandler
+	
+	def tearDown(self):
+		if hasattr(self, 'handler'):
+			del typemapper[self.handler]
+		if hasattr(settings, 'PISTON_READ_DATABASES'):
+			del settings.PISTON_READ_DATABASES
+		cache.clear()
+	
+	def request(self, method='get'):
+		request = getattr(RequestFactory(), method)('/')
+		request.user = User()
+		return request
+	
+	def test_read_database(self):
+		self.assertEqual(routing.read_database(self.request()), REPLICA)
+		self.assertEqual(routing.read_database(self.request('post')), None)
+	
+	def test_no_replicas(self):
+		del settings.PISTON_READ_DATABASES
+		self.assertEqual(routing.read_database(self.request()), None)
+	
+	def test_read_your_writes(self):
+		routing.written(self.request('post'))
+		self.assertEqual(routing.read_database(self.request()), DEFAULT_DB_ALIAS)
+	
+	def test_data_set(self):
+		data = self.handler().data_set(self.request())
+		self.assertEqual([tombstone.model for tombstone in data], ['replica'])
+	
+	def test_data_set_after_write(self):
+		routing.written(self.request('post'))
+		data = self.handler().data_set(self.request())
+		self.assertEqual([tombstone.model for tombstone in data], ['primary'])
+	
+	def test_fetch(self):
+		fetched = IdentityMap().fetch(Tombstone, [self.replicated.pk], REPLICA)
+		self.assertEqual([tombstone.model for tombstone in fetched], ['replica'])
+		self.assertEqual(fetched[0]._state.db, REPLICA)
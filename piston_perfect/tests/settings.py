@@ -0,0 +1,33 @@
+"""
+Settings for running the tests on their own, with two SQLite databases:
+``'default'`` and ``'replica'``, which stands in for a replica (but is not
+replicated to). See ``runtests.py``.
+"""
+
+DATABASES = {
+	'default': {
+		'ENGINE': 'django.db.backends.sqlite3',
+		'NAME': 'piston_perfect_default',
+	},
+	'replica': {
+		'ENGINE': 'django.db.backends.sqlite3',
+		'NAME': 'piston_perfect_replica',
+	},
+}
+
+CACHES = {
+	'default': {
+		'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+	},
+}
+
+INSTALLED_APPS = (
+	'django.contrib.auth',
+	'django.contrib.contenttypes',
+	'django.contrib.sessions',
+	'piston_perfect',
+)
+
+SECRET_KEY = 'piston-perfect-tests'
+
+USE_I18N = False
@@ -1,3 +1,44 @@
+import threading
+from django.db import connections
+
+
 class MethodNotAllowed(Exception):
 	def __init__(self, *permitted_methods):
 		self.permitted_methods = permitted_methods
+
+class QueryBudgetExceeded(Exception):
+	pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(name, size):
+	"""
+	Returns the process-wide thread pool named *name*, creating it with *size*
+	worker threads on first use. Pools are shared between requests so that
+	we do not pay for spawning threads on every request, and so that the
+	number of database connections they open stays bounded.
+	"""
+	with _pools_lock:
+		if not name in _pools:
+			# Is imported here rather than at module level, as it takes a
+			# few dozen modules that a process without pools can do without.
+			from multiprocessing.pool import ThreadPool
+			_pools[name] = ThreadPool(size)
+		return _pools[name]
+
+def in_thread(func):
+	"""
+	Wraps *func* for execution in a pool thread. Django's database
+	connections are thread-local, so every worker thread opens its own; we
+	close them as soon as *func* is done so that they don't linger (or end up
+	being shared with unrelated work that happens to land on the same thread).
+	"""
+	def wrapper(*args, **kwargs):
+		try:
+			return func(*args, **kwargs)
+		finally:
+			for connection in connections.all():
+				connection.close()
+	return wrapper
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+"""
+Runs the tests of :mod:`piston_perfect` with the settings in
+``piston_perfect/tests/settings.py``, or with the settings module named by
+``DJANGO_SETTINGS_MODULE``. Usage::
+
+	python runtests.py [<test label> ...]
+
+in which the test labels are as for ``manage.py test`` (``piston_perfect``
+by default).
+"""
+
+import os, sys
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'piston_perfect.tests.settings')
+
+from django.conf import settings
+from django.test.utils import get_runner
+
+
+def main(labels):
+	runner = get_runner(settings)(verbosity=1, interactive=False)
+	failures = runner.run_tests(labels or ['piston_perfect'])
+	sys.exit(bool(failures))
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -11,7 +11,7 @@ setup(
 	author="Tim Molendijk",
 	author_email="tim@smart.pr",
 	url="http://github.com/smartpr/piston-perfect",
-	packages=('piston_perfect', ),
+	packages=('piston_perfect', 'piston_perfect.management', 'piston_perfect.management.commands', 'piston_perfect.tests', ),
 	install_requires=(
 		# Really should be required by Piston, but as that currently doesn't
 		# happen we do it here instead. We are not sure about which Django